@@ -0,0 +1,241 @@
+"""Микробенчмарки горячих путей main.py — в процессе, без Telegram и без БД.
+
+    python bench.py matchmaker --queued 10000 --matches 200000
+    python bench.py ratelimit --users 1000000 --wave 100000
+    python bench.py fsm --users 100000
+    python bench.py sendpath --messages 20000
+
+main.py импортируется как модуль, поэтому обязательные переменные окружения
+подставляются заглушками, если не заданы.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SendMessage
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("MODERATION_CHANNEL_ID", "-100500")
+os.environ.setdefault("DATABASE_URL", "postgresql://bench@127.0.0.1/bench")
+
+import main as bot
+
+# === ПОДБОР СОБЕСЕДНИКОВ ===
+def bench_matchmaker(args):
+    """Пары в секунду при заданной глубине очереди.
+
+    Очередь заполняется парнями, которые ищут девушек, — между собой они не совпадают.
+    Каждая пришедшая девушка сразу забирает одного из них, а его место в очереди
+    занимает новый, так что глубина держится на --queued весь замер.
+    """
+    rng = random.Random(args.seed)
+    for name, policy in bot.MATCH_POLICIES.items():
+        matchmaker = bot.Matchmaker(policy)
+        for user_id in range(args.queued):
+            matchmaker.enqueue(user_id, "male", "female", rng.choice(bot.TIERS))
+        next_id = args.queued
+        matched = 0
+        started = time.perf_counter()
+        for _ in range(args.matches):
+            pref = rng.choice(("male", "any"))
+            result = matchmaker.enqueue(next_id, "female", pref, rng.choice(bot.TIERS))
+            next_id += 1
+            if result is not None:
+                matched += 1
+                matchmaker.enqueue(next_id, "male", "female", rng.choice(bot.TIERS))
+                next_id += 1
+        elapsed = time.perf_counter() - started
+        print(
+            f"{name:16} в очереди {len(matchmaker):>7}, пар {matched:>8}, "
+            f"{matched / elapsed:>10.0f} пар/с, {elapsed / args.matches * 1e6:.2f}мкс на enqueue"
+        )
+
+# === ЛИМИТЫ И КАПЧА ===
+def bench_ratelimit(args):
+    """Память лимитера и капчи на потоке новых пользователей.
+
+    Пользователи приходят волнами по --wave уникальных id, каждый делает пару команд,
+    часть получает капчу. Между волнами проходит окно лимита и TTL капчи, и работает
+    уборка — как фоновый sweep MemoryStateBackend. Память после уборки не должна расти
+    с числом пользователей, которых бот уже видел.
+    """
+    rng = random.Random(args.seed)
+    limiter = bot.RateLimiter(bot.RATE_LIMIT, bot.RATE_WINDOW)
+    captcha = {}
+    idle = max(bot.RATE_WINDOW, bot.CAPTCHA_TTL) + 1
+    now = 0.0
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for first in range(0, args.users, args.wave):
+        started = time.perf_counter()
+        for user_id in range(first, min(first + args.wave, args.users)):
+            for _ in range(rng.randint(1, 3)):
+                limiter.hit(user_id, now)
+            if rng.random() < 0.05:
+                captcha[user_id] = bot.CaptchaRecord("🍎", 0, now + bot.CAPTCHA_TTL)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[0] - baseline
+        now += idle
+        asyncio.run(limiter.sweep(now))
+        asyncio.run(bot._evict(captcha, lambda record: record.expires_at <= now))
+        current = tracemalloc.get_traced_memory()[0] - baseline
+        print(
+            f"видели {min(first + args.wave, args.users):>8}, на пике волны {peak / 2**20:7.1f}МБ, "
+            f"после уборки {current / 2**20:6.2f}МБ, записей {len(limiter) + len(captcha):>6}, "
+            f"{elapsed / args.wave * 1e9:.0f}нс на пользователя"
+        )
+    tracemalloc.stop()
+
+# === ХРАНИЛИЩЕ FSM ===
+async def fsm_lifecycle(storage, users: int, seed: int):
+    """Типичный путь пользователя через FSM: чтения на каждом апдейте, онбординг, чат, оценка."""
+    rng = random.Random(seed)
+    for user_id in range(1, users + 1):
+        key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+        await storage.get_state(key)
+        await storage.set_state(key, bot.UserState.choosing_own_gender)
+        await storage.set_data(key, {"temp_user": {"own_gender": "male"}})
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        await storage.get_state(key)
+        roll = rng.random()
+        if roll < 0.2:
+            await storage.set_state(key, bot.UserState.in_chat)
+        elif roll < 0.3:
+            await storage.set_state(key, bot.UserState.rating_partner)
+            await storage.set_data(key, {"rating_partner": user_id + 1})
+
+async def measure_fsm(make_storage, args) -> tuple:
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    storage = make_storage()
+    started = time.perf_counter()
+    await fsm_lifecycle(storage, args.users, args.seed)
+    elapsed = time.perf_counter() - started
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    spilled = None
+    if isinstance(storage, bot.CompactMemoryStorage) and storage._spill is not None:
+        await storage._spill_idle(time.time() + storage.spill_after + 1)
+        spilled = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    await storage.close()
+    return used, spilled, elapsed
+
+def bench_fsm(args):
+    """Память FSM-хранилища на --users пользователей: MemoryStorage против CompactMemoryStorage."""
+    with tempfile.TemporaryDirectory() as directory:
+        variants = {
+            "MemoryStorage": MemoryStorage,
+            "Compact": lambda: bot.CompactMemoryStorage(bot.FSM_STATE_TTLS, bot.FSM_STATE_TTL),
+            "Compact+sqlite": lambda: bot.CompactMemoryStorage(
+                bot.FSM_STATE_TTLS, bot.FSM_STATE_TTL, os.path.join(directory, "spill"), bot.FSM_SPILL_AFTER,
+            ),
+        }
+        for name, make_storage in variants.items():
+            used, spilled, elapsed = asyncio.run(measure_fsm(make_storage, args))
+            line = (
+                f"{name:14} {used / 2**20:7.1f}МБ, {used / args.users:6.0f}Б на пользователя, "
+                f"{elapsed / args.users * 1e6:.1f}мкс на путь"
+            )
+            if spilled is not None:
+                line += f"; после выгрузки простаивающих {spilled / 2**20:.1f}МБ, {spilled / args.users:.0f}Б"
+            print(line)
+
+# === ОТПРАВКА ===
+# Клавиатуры в том виде, как их собирали на каждый ответ до кэша в main.py
+def legacy_idle_kb():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="/search"), KeyboardButton(text="/gender")]
+        ],
+        resize_keyboard=True
+    )
+
+def legacy_rating_kb(partner_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="👍 Хороший", callback_data=f"rate_{partner_id}_1")],
+        [InlineKeyboardButton(text="👎 Неадекват", callback_data=f"rate_{partner_id}_0")]
+    ])
+
+def bench_sendpath(args):
+    """Отправка ответа с клавиатурой до и после кэша клавиатур.
+
+    Память — сколько байт новых объектов клавиатура добавляет на каждое сообщение
+    (tracemalloc, объекты удерживаются до конца замера). Время — сборка SendMessage
+    и формы запроса, как их строит AiohttpSession, без tracemalloc.
+
+    У кнопок оценки id собеседников не повторяются, как в жизни: каждый диалог заканчивается
+    с новым собеседником. Поэтому кнопки оценки в main.py не кэшируются, и «после» у них
+    та же сборка, что «до», — строка показывает цену этого пути, а не выигрыш.
+    """
+    partners = itertools.count(random.Random(args.seed).randrange(1, 10**9))
+    paths = {
+        "простой ответ": (
+            lambda i: legacy_idle_kb(),
+            lambda i: bot.IDLE_KB,
+            bot.CHOOSE_ACTION_TEXT,
+        ),
+        "оценка": (
+            lambda i: legacy_rating_kb(next(partners)),
+            lambda i: bot.get_rating_kb(next(partners)),
+            "Оцените собеседника:",
+        ),
+    }
+    session = bot.bot.session
+    for name, (before, after, text) in paths.items():
+        for label, markup in (("до", before), ("после", after)):
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            kept = [markup(i) for i in range(args.messages)]
+            allocated = tracemalloc.get_traced_memory()[0] - baseline
+            tracemalloc.stop()
+            del kept
+            started = time.perf_counter()
+            for i in range(args.messages):
+                markup(i)
+            build = time.perf_counter() - started
+            started = time.perf_counter()
+            for i in range(args.messages):
+                session.build_form_data(bot.bot, SendMessage(chat_id=i, text=text, reply_markup=markup(i)))
+            send = time.perf_counter() - started
+            print(
+                f"{name:14} {label:6} клавиатура {allocated / args.messages:7.0f}Б и "
+                f"{build / args.messages * 1e6:5.1f}мкс, весь путь {send / args.messages * 1e6:6.1f}мкс на сообщение"
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки анонимного чат-бота")
+    parser.add_argument("--seed", type=int, default=1)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    matchmaker = commands.add_parser("matchmaker", help="пары в секунду при глубокой очереди")
+    matchmaker.add_argument("--queued", type=int, default=10_000, help="сколько пользователей ждёт в очереди")
+    matchmaker.add_argument("--matches", type=int, default=200_000, help="сколько входящих поставить в очередь")
+    matchmaker.set_defaults(run=bench_matchmaker)
+
+    ratelimit = commands.add_parser("ratelimit", help="память лимитера и капчи на миллионе пользователей")
+    ratelimit.add_argument("--users", type=int, default=1_000_000, help="сколько разных пользователей")
+    ratelimit.add_argument("--wave", type=int, default=100_000, help="сколько новых пользователей между уборками")
+    ratelimit.set_defaults(run=bench_ratelimit)
+
+    fsm = commands.add_parser("fsm", help="память FSM-хранилища против MemoryStorage")
+    fsm.add_argument("--users", type=int, default=100_000)
+    fsm.set_defaults(run=bench_fsm)
+
+    sendpath = commands.add_parser("sendpath", help="аллокации на отправке: до и после кэша клавиатур")
+    sendpath.add_argument("--messages", type=int, default=20_000)
+    sendpath.set_defaults(run=bench_sendpath)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,559 @@
+"""Нагрузочный прогон бота против локальной заглушки Bot API и локального PostgreSQL.
+
+Запускает main.py отдельным процессом с TELEGRAM_API_URL, указывающим на заглушку,
+и прогоняет N симулированных пользователей по сценарию
+/start → пол → /search → переписка → /next или /stop → оценка.
+
+    python loadtest.py --users 2000 --messages 20 --seed 1
+    python loadtest.py --database-url postgresql://localhost/loadtest --reset --json report.json
+
+Сравнение одного процесса с супервизором на тех же пользователях и seed:
+
+    python loadtest.py --users 2000 --seed 1 --json one.json
+    python loadtest.py --users 2000 --seed 1 --workers 4 --json four.json
+
+Без --database-url поднимает временный кластер через initdb/pg_ctl.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+import asyncpg
+from aiohttp import web
+
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+MODERATION_CHANNEL_ID = -100500
+FIRST_USER_ID = 10_000_000
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summary(values: list) -> dict:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p90": percentile(values, 0.90),
+        "p99": percentile(values, 0.99),
+        "max": max(values, default=0.0),
+        "mean": statistics.fmean(values) if values else 0.0,
+    }
+
+def rss_of_tree(pid: int) -> int:
+    """RSS процесса вместе с дочерними (воркеры супервизора), в байтах."""
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for children in glob.glob(f"/proc/{current}/task/*/children"):
+                with open(children) as f:
+                    stack.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+# === ЗАГЛУШКА BOT API ===
+class FakeBotApi:
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.inboxes = {}
+        self.calls = {}
+        self._new_updates = asyncio.Event()
+        self.polled = asyncio.Event()
+
+    def push_update(self, payload: dict):
+        payload["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(payload)
+        self._new_updates.set()
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _deliver(self, method: str, chat_id: int, params: dict):
+        inbox = self.inboxes.get(chat_id)
+        if inbox is not None:
+            inbox.put_nowait((time.perf_counter(), method, params))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, f"api_{method.lower()}", None)
+        if handler is None:
+            result = self.api_default(method, params)
+        else:
+            result = await handler(params)
+        return web.json_response({"ok": True, "result": result})
+
+    async def api_getme(self, params: dict):
+        return BOT_USER
+
+    async def api_deletewebhook(self, params: dict):
+        return True
+
+    async def api_getupdates(self, params: dict):
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        while True:
+            # Подтверждённые апдейты (id < offset) больше не нужны
+            drop = 0
+            while drop < len(self.updates) and self.updates[drop]["update_id"] < offset:
+                drop += 1
+            del self.updates[:drop]
+            if self.updates or time.monotonic() >= deadline:
+                return self.updates[:100]
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+
+    async def api_answercallbackquery(self, params: dict):
+        return True
+
+    async def api_editmessagetext(self, params: dict):
+        chat_id = int(params["chat_id"])
+        self._deliver("editMessageText", chat_id, params)
+        return self._message(chat_id, text=params.get("text", ""))
+
+    async def api_sendmediagroup(self, params: dict):
+        chat_id = int(params["chat_id"])
+        self._deliver("sendMediaGroup", chat_id, params)
+        return [self._message(chat_id) for _ in json.loads(params["media"])]
+
+    async def api_copymessage(self, params: dict):
+        chat_id = int(params["chat_id"])
+        self._deliver("copyMessage", chat_id, params)
+        return {"message_id": self.next_message_id}
+
+    def api_default(self, method: str, params: dict):
+        chat_id = int(params["chat_id"])
+        self._deliver(method, chat_id, params)
+        return self._message(chat_id, text=params.get("text", ""))
+
+# === СИМУЛИРОВАННЫЕ ПОЛЬЗОВАТЕЛИ ===
+class SimUser:
+    def __init__(self, user_id: int, rng: random.Random):
+        self.user_id = user_id
+        self.rng = rng
+        self.gender = rng.choice(["Мужчина", "Женщина"])
+        self.inbox = asyncio.Queue()
+        self.control = asyncio.Queue()
+        self.backlog = []
+        self.partner_left = False
+        self.next_message_id = 1
+
+class LoadTest:
+    def __init__(self, args, api: FakeBotApi):
+        self.args = args
+        self.api = api
+        self.users = []
+        self.time_to_match = []
+        self.handler_latency = {}
+        self.relay_latency = []
+        self.relay_sent = 0
+        self.relay_received = 0
+        self.unmatched = 0
+        self.errors = 0
+        self.chat_started = None
+        self.chat_finished = None
+
+    # --- апдейты от имени пользователя ---
+    def _from(self, user: SimUser) -> dict:
+        return {"id": user.user_id, "is_bot": False, "first_name": f"u{user.user_id}"}
+
+    def send_text(self, user: SimUser, text: str):
+        message_id = user.next_message_id
+        user.next_message_id += 1
+        self.api.push_update({"message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user.user_id, "type": "private"},
+            "from": self._from(user),
+            "text": text,
+        }})
+
+    def send_callback(self, user: SimUser, data: str):
+        self.api.push_update({"callback_query": {
+            "id": f"{user.user_id}-{time.perf_counter_ns()}",
+            "from": self._from(user),
+            "chat_instance": str(user.user_id),
+            "data": data,
+            "message": {
+                "message_id": user.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": user.user_id, "type": "private"},
+                "text": "Оцените собеседника:",
+            },
+        }})
+
+    async def route_inbox(self, user: SimUser):
+        # Пересланные собеседником сообщения считаем сразу, остальное — в очередь сценария
+        while True:
+            received_at, method, params = await user.inbox.get()
+            text = params.get("text", "")
+            if method == "sendMessage" and text.startswith("m "):
+                _, _, sent_at = text.split(" ", 2)
+                self.relay_latency.append(received_at - float(sent_at))
+                self.relay_received += 1
+                continue
+            if "покинул чат" in text:
+                user.partner_left = True
+            user.control.put_nowait((method, params))
+
+    async def expect(self, user: SimUser, *needles: str, timeout: float = 30.0):
+        # Ответы могут прийти в другом порядке, поэтому неподошедшие откладываем, а не выбрасываем
+        for i, params in enumerate(user.backlog):
+            if any(needle in params.get("text", "") for needle in needles):
+                return user.backlog.pop(i)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            method, params = await asyncio.wait_for(user.control.get(), remaining)
+            if any(needle in params.get("text", "") for needle in needles):
+                return params
+            user.backlog.append(params)
+            del user.backlog[:-20]
+
+    async def step(self, user: SimUser, name: str, text: str, *needles: str, timeout: float = 30.0):
+        started = time.perf_counter()
+        self.send_text(user, text)
+        params = await self.expect(user, *needles, timeout=timeout)
+        self.handler_latency.setdefault(name, []).append(time.perf_counter() - started)
+        return params
+
+    # --- сценарий ---
+    async def run_user(self, user: SimUser, start_delay: float):
+        await asyncio.sleep(start_delay)
+        router = asyncio.create_task(self.route_inbox(user))
+        try:
+            reply = await self.step(user, "start", "/start", "Добро пожаловать", "Выберите действие")
+            if "Добро пожаловать" in reply.get("text", ""):
+                await self.step(user, "gender", user.gender, "Кого вы хотите найти")
+                pref = "Микс (любой)" if user.rng.random() < self.args.mix_share else user.rng.choice(
+                    ["Только парни", "Только девушки"]
+                )
+                await self.step(user, "preference", pref, "Готово")
+            command = "/search"
+            for round_no in range(self.args.rounds):
+                if not await self.search(user, command):
+                    break
+                await self.chat(user)
+                command = "/search"
+                if user.partner_left:
+                    continue
+                if round_no < self.args.rounds - 1 and user.rng.random() < self.args.next_share:
+                    command = "/next"
+                else:
+                    await self.leave(user)
+        except asyncio.TimeoutError:
+            self.errors += 1
+        finally:
+            router.cancel()
+
+    async def search(self, user: SimUser, command: str) -> bool:
+        user.backlog.clear()
+        if command == "/next":
+            await self.leave(user, command)
+            await self.expect(user, "Начат поиск")
+        else:
+            await self.step(user, "search", command, "Начат поиск")
+        started = time.perf_counter()
+        user.partner_left = False
+        try:
+            reply = await self.expect(user, "Собеседник найден", "Не удалось найти", timeout=self.args.match_timeout)
+        except asyncio.TimeoutError:
+            reply = None
+        if reply is None or "Не удалось" in reply.get("text", ""):
+            self.unmatched += 1
+            await self.step(user, "stop", "/stop", "Вы не в чате", "Оцените собеседника")
+            return False
+        self.time_to_match.append(time.perf_counter() - started)
+        return True
+
+    async def chat(self, user: SimUser):
+        if self.chat_started is None:
+            self.chat_started = time.perf_counter()
+        for _ in range(self.args.messages):
+            if user.partner_left:
+                break
+            self.send_text(user, f"m {user.user_id} {time.perf_counter()}")
+            self.relay_sent += 1
+            await asyncio.sleep(self.args.message_interval * user.rng.uniform(0.5, 1.5))
+        self.chat_finished = time.perf_counter()
+
+    async def leave(self, user: SimUser, command: str = "/stop"):
+        reply = await self.step(user, command[1:], command, "Оцените собеседника", "Вы не в чате")
+        if "Оцените" not in reply.get("text", ""):
+            return
+        markup = json.loads(reply.get("reply_markup") or "{}")
+        buttons = [b for row in markup.get("inline_keyboard", []) for b in row]
+        if buttons:
+            started = time.perf_counter()
+            self.send_callback(user, user.rng.choice(buttons)["callback_data"])
+            await self.expect(user, "Спасибо за оценку", "Ошибка оценки")
+            self.handler_latency.setdefault("rating", []).append(time.perf_counter() - started)
+
+    async def run(self):
+        rng = random.Random(self.args.seed)
+        for i in range(self.args.users):
+            user = SimUser(FIRST_USER_ID + i, random.Random(rng.random()))
+            self.api.inboxes[user.user_id] = user.inbox
+            self.users.append(user)
+        ramp = self.args.ramp
+        await asyncio.gather(*(
+            self.run_user(user, ramp * i / max(1, len(self.users)))
+            for i, user in enumerate(self.users)
+        ))
+
+# === POSTGRES ===
+class TempPostgres:
+    """Одноразовый кластер PostgreSQL во временном каталоге."""
+
+    def __init__(self):
+        self.dir = None
+        self.port = free_port()
+        self.bin = self._find_bin()
+
+    @staticmethod
+    def _find_bin():
+        if shutil.which("initdb"):
+            return os.path.dirname(shutil.which("initdb"))
+        candidates = sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"))
+        if not candidates:
+            raise SystemExit("❌ initdb не найден: установите PostgreSQL или передайте --database-url")
+        return os.path.dirname(candidates[-1])
+
+    async def _run(self, *cmd):
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, err = await proc.communicate()
+        if proc.returncode:
+            raise SystemExit(f"❌ {cmd[0]}: {err.decode()}")
+
+    async def start(self) -> str:
+        self.dir = tempfile.mkdtemp(prefix="loadtest-pg-")
+        data = os.path.join(self.dir, "data")
+        await self._run(os.path.join(self.bin, "initdb"), "-D", data, "-U", "postgres", "-A", "trust")
+        await self._run(
+            os.path.join(self.bin, "pg_ctl"), "-D", data, "-w", "-l", os.path.join(self.dir, "log"),
+            "-o", f"-p {self.port} -k {self.dir} -c listen_addresses=127.0.0.1 -c fsync=off",
+            "start",
+        )
+        return f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    async def stop(self):
+        if self.dir:
+            await self._run(os.path.join(self.bin, "pg_ctl"), "-D", os.path.join(self.dir, "data"), "-m", "fast", "stop")
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+async def reset_database(database_url: str):
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute("DROP TABLE IF EXISTS users, ratings, reports, user_reputation, schema_version CASCADE")
+    finally:
+        await conn.close()
+
+async def transactions_count(database_url: str) -> int:
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute("SELECT pg_stat_clear_snapshot()")
+        return await conn.fetchval(
+            "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"
+        )
+    finally:
+        await conn.close()
+
+# === ЗАПУСК ===
+async def start_bot(args, api_url: str, database_url: str):
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "MODERATION_CHANNEL_ID": str(MODERATION_CHANNEL_ID),
+        "DATABASE_URL": database_url,
+        "TELEGRAM_API_URL": api_url,
+        "PYTHONUNBUFFERED": "1",
+    }
+    env.pop("WEBHOOK_URL", None)
+    if args.workers > 1:
+        env["WORKERS"] = str(args.workers)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+        env=env,
+        stdout=None if args.verbose else asyncio.subprocess.DEVNULL,
+        stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+    )
+
+async def sample_rss(pid: int, samples: list, stop: asyncio.Event):
+    while not stop.is_set():
+        samples.append(rss_of_tree(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+
+def build_report(test: LoadTest, api: FakeBotApi, duration: float, db_transactions: int, rss: list) -> dict:
+    chat_time = (test.chat_finished or 0) - (test.chat_started or 0)
+    return {
+        "users": test.args.users,
+        "seed": test.args.seed,
+        "duration_s": duration,
+        "errors": test.errors,
+        "unmatched": test.unmatched,
+        "time_to_match_s": summary(test.time_to_match),
+        "relay": {
+            "sent": test.relay_sent,
+            "received": test.relay_received,
+            "throughput_per_s": test.relay_received / chat_time if chat_time > 0 else 0.0,
+            "latency_s": summary(test.relay_latency),
+        },
+        "handler_latency_s": {name: summary(values) for name, values in sorted(test.handler_latency.items())},
+        "db": {
+            "transactions": db_transactions,
+            "per_relayed_message": db_transactions / test.relay_received if test.relay_received else 0.0,
+        },
+        "rss_mb": {
+            "start": rss[0] / 2**20 if rss else 0.0,
+            "peak": max(rss, default=0) / 2**20,
+            "end": rss[-1] / 2**20 if rss else 0.0,
+            "growth": (rss[-1] - rss[0]) / 2**20 if rss else 0.0,
+        },
+        "api_calls": dict(sorted(api.calls.items())),
+    }
+
+def print_report(report: dict):
+    def line(name, s):
+        print(f"  {name:<14} p50 {s['p50'] * 1000:8.1f}мс  p90 {s['p90'] * 1000:8.1f}мс  "
+              f"p99 {s['p99'] * 1000:8.1f}мс  max {s['max'] * 1000:8.1f}мс  (n={s['count']})")
+
+    print(f"\n📊 Пользователей: {report['users']}, seed {report['seed']}, "
+          f"длительность {report['duration_s']:.1f}с, ошибок {report['errors']}, без пары {report['unmatched']}")
+    print("Время до собеседника:")
+    line("match", report["time_to_match_s"])
+    relay = report["relay"]
+    print(f"Пересылка: отправлено {relay['sent']}, доставлено {relay['received']}, "
+          f"{relay['throughput_per_s']:.1f} сообщ/с")
+    line("relay", relay["latency_s"])
+    print("Обработчики:")
+    for name, s in report["handler_latency_s"].items():
+        line(name, s)
+    db = report["db"]
+    print(f"БД: транзакций {db['transactions']}, на пересланное сообщение {db['per_relayed_message']:.3f}")
+    rss = report["rss_mb"]
+    print(f"RSS: старт {rss['start']:.1f}МБ, пик {rss['peak']:.1f}МБ, конец {rss['end']:.1f}МБ, "
+          f"рост {rss['growth']:+.1f}МБ")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест анонимного чат-бота")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20, help="сообщений от каждого в диалоге")
+    parser.add_argument("--rounds", type=int, default=2, help="сколько раз каждый ищет собеседника")
+    parser.add_argument("--message-interval", type=float, default=1.0)
+    parser.add_argument("--next-share", type=float, default=0.5, help="доля диалогов, завершаемых через /next")
+    parser.add_argument("--mix-share", type=float, default=0.7, help="доля ищущих «Микс»")
+    parser.add_argument("--match-timeout", type=float, default=60.0)
+    parser.add_argument("--ramp", type=float, default=10.0, help="за сколько секунд подключаются все")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", default=os.getenv("LOADTEST_DATABASE_URL"))
+    parser.add_argument("--reset", action="store_true", help="удалить таблицы бота перед прогоном")
+    parser.add_argument("--workers", type=int, default=1, help="запустить бота супервизором с N воркерами")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для процесса бота")
+    parser.add_argument("--json", help="куда сохранить отчёт")
+    parser.add_argument("--verbose", action="store_true", help="показывать вывод бота")
+    args = parser.parse_args()
+
+    postgres = None
+    database_url = args.database_url
+    if not database_url:
+        postgres = TempPostgres()
+        database_url = await postgres.start()
+    elif not args.reset:
+        print("⚠️ База не сбрасывается — для повторяемых цифр используйте --reset на отдельной БД")
+    if postgres or args.reset:
+        await reset_database(database_url)
+
+    api = FakeBotApi()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    proc = await start_bot(args, f"http://127.0.0.1:{port}", database_url)
+    rss, stop_sampling = [], asyncio.Event()
+    sampler = None
+    try:
+        await asyncio.wait_for(api.polled.wait(), 60)
+        sampler = asyncio.create_task(sample_rss(proc.pid, rss, stop_sampling))
+        db_before = await transactions_count(database_url)
+        test = LoadTest(args, api)
+        started = time.perf_counter()
+        await test.run()
+        duration = time.perf_counter() - started
+        await asyncio.sleep(1)
+        db_after = await transactions_count(database_url)
+        stop_sampling.set()
+        await sampler
+        report = build_report(test, api, duration, db_after - db_before, rss)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+    finally:
+        stop_sampling.set()
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 15)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await runner.cleanup()
+        if postgres:
+            await postgres.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,31 +1,132 @@
 import asyncio
+import json
 import logging
+import sqlite3
 import time
+import heapq
+import itertools
+import math
 import random
-from collections import defaultdict
-from aiogram import Bot, Dispatcher, types
+import signal
+import struct
+import sys
+import tempfile
+from array import array
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+from functools import partial
+from aiogram import BaseMiddleware, Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from aiohttp import web
 from dotenv import load_dotenv
+from urllib.parse import urlparse
 import os
 import asyncpg
+from redis.asyncio import Redis
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 
 load_dotenv()
 
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-CHANNEL_ID = int(os.getenv("MODERATION_CHANNEL_ID"))
+# `python main.py migrate` нужна только DATABASE_URL: в Telegram этот режим не ходит,
+# поэтому токен и канал модерации могут быть не заданы
+MIGRATE_ONLY = __name__ == "__main__" and sys.argv[1:] == ["migrate"]
+if MIGRATE_ONLY:
+    BOT_TOKEN = os.getenv("BOT_TOKEN") or "0:migrate"
+    CHANNEL_ID = int(os.getenv("MODERATION_CHANNEL_ID") or 0)
+else:
+    BOT_TOKEN = os.getenv("BOT_TOKEN")
+    CHANNEL_ID = int(os.getenv("MODERATION_CHANNEL_ID"))
 DATABASE_URL = os.getenv("DATABASE_URL")
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(","))) if os.getenv("ADMIN_IDS") else []
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+MATCH_POLICY = os.getenv("MATCH_POLICY", "fifo")
+REPUTATION_MODE = os.getenv("REPUTATION_MODE", "off")
+REPUTATION_MIN_VOTES = int(os.getenv("REPUTATION_MIN_VOTES", "5"))
+REPUTATION_LOW_SHARE = float(os.getenv("REPUTATION_LOW_SHARE", "0.5"))
+REPUTATION_HIGH_SHARE = float(os.getenv("REPUTATION_HIGH_SHARE", "0.1"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "anonchat")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "2000"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_ADMIT_TIMEOUT = float(os.getenv("WEBHOOK_ADMIT_TIMEOUT", "10"))
+# Сколько инстансов бота с этим токеном работает за балансировщиком. OUTBOX_GLOBAL_RATE — лимит
+# Telegram на весь бот, поэтому каждый инстанс отправляет не больше OUTBOX_GLOBAL_RATE / INSTANCES.
+# Порядок апдейтов одного пользователя гарантируется только при INSTANCES=1: между инстансами
+# его никто не согласует
+INSTANCES = int(os.getenv("INSTANCES", "1"))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "5"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", "2"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+METRICS_ENABLED = METRICS_PORT > 0
+SEARCH_WARN_AFTER = 120
+SEARCH_TIMEOUT = 300
+RATE_LIMIT = 30
+RATE_WINDOW = 60
+CAPTCHA_TTL = 600
+STATE_SWEEP_INTERVAL = 60
+STATE_DIR = os.getenv("STATE_DIR")
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "30"))
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_SPILL_PATH = os.getenv("FSM_SPILL_PATH")
+FSM_SPILL_AFTER = float(os.getenv("FSM_SPILL_AFTER", "600"))
+# WORKERS > 1 — режим супервизора: этот процесс опрашивает Telegram и раздаёт апдейты воркерам,
+# а WORKER_INDEX и IPC_DIR супервизор сам выставляет запущенным воркерам
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "-1"))
+IPC_DIR = os.getenv("IPC_DIR")
+IS_WORKER = WORKERS > 1 and WORKER_INDEX >= 0
+IS_SUPERVISOR = WORKERS > 1 and not IS_WORKER
+# Сколько апдейтов супервизор держит в очереди к одному воркеру, пока тот занят или перезапускается
+WORKER_MAX_PENDING = int(os.getenv("WORKER_MAX_PENDING", "5000"))
+MODERATION_SEEN_SIZE = int(os.getenv("MODERATION_SEEN_SIZE", "50000"))
+MODERATION_BATCH_WINDOW = float(os.getenv("MODERATION_BATCH_WINDOW", "2"))
+MODERATION_BACKLOG_LIMIT = int(os.getenv("MODERATION_BACKLOG_LIMIT", "200"))
+RELAY_ALBUM_WINDOW = float(os.getenv("RELAY_ALBUM_WINDOW", "0.5"))
+# Очередь пересылки ограничена: сверх RELAY_MAX_PENDING обработчик ждёт места (до RELAY_ADMIT_TIMEOUT),
+# а сверх RELAY_SENDER_LIMIT сообщений одного отправителя новые отклоняются
+RELAY_MAX_PENDING = int(os.getenv("RELAY_MAX_PENDING", "2000"))
+RELAY_SENDER_LIMIT = int(os.getenv("RELAY_SENDER_LIMIT", "50"))
+RELAY_ADMIT_TIMEOUT = float(os.getenv("RELAY_ADMIT_TIMEOUT", "10"))
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "600"))
 
 if not BOT_TOKEN or not DATABASE_URL:
     raise ValueError("❌ BOT_TOKEN или DATABASE_URL не заданы!")
+if INSTANCES < 1:
+    raise ValueError("❌ INSTANCES должен быть не меньше 1")
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# TELEGRAM_API_URL — свой Bot API сервер (локальный telegram-bot-api или заглушка из loadtest.py)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
+redis = Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
 
 # === СОСТОЯНИЯ ===
 class UserState(StatesGroup):
@@ -37,134 +138,2227 @@ class UserState(StatesGroup):
     confirming_link = State()
     rating_partner = State()
 
+# === ХРАНИЛИЩЕ FSM ===
+# Сколько живёт состояние с момента последней записи; остальные состояния живут FSM_STATE_TTL
+FSM_STATE_TTLS = {
+    UserState.choosing_own_gender.state: 3600,
+    UserState.choosing_search_pref.state: 3600,
+    UserState.waiting_for_captcha.state: CAPTCHA_TTL,
+    UserState.confirming_link.state: 600,
+    UserState.rating_partner.state: 3600,
+}
+
+class FSMRecord:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state, data, touched: float):
+        self.state = state
+        self.data = data
+        self.touched = touched
+
+class CompactMemoryStorage(BaseStorage):
+    """FSM-хранилище в памяти, которое не растёт от неактивных пользователей.
+
+    В отличие от MemoryStorage чтение не создаёт записей, а пустая запись (нет ни состояния,
+    ни данных) сразу удаляется. Остальные живут TTL своего состояния и вычищаются фоном.
+    С spill_path давно не тронутые записи переезжают в файл SQLite и возвращаются в память
+    при следующем обращении. SQLite, а не dbm: без gdbm dbm.open отдаёт dbm.dumb, который
+    держит весь индекс ключей в памяти и не переиспользует место удалённых записей.
+    """
+
+    def __init__(self, ttls: dict, default_ttl: float, spill_path: str = None, spill_after: float = 600):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.spill_after = spill_after
+        self.spilled = 0
+        self._records = {}
+        self._bot_id = None
+        self._spill = self._open_spill(spill_path) if spill_path else None
+        self._spill_swept_at = time.time()
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @staticmethod
+    def _open_spill(path: str):
+        # Каждый запуск с чистого файла: состояния в памяти после рестарта тоже пустые.
+        # Поэтому и журнал не нужен — после падения файл всё равно пересоздаётся
+        if os.path.exists(path):
+            os.remove(path)
+        spill = sqlite3.connect(path)
+        spill.execute("PRAGMA journal_mode = OFF")
+        spill.execute("PRAGMA synchronous = OFF")
+        spill.execute("CREATE TABLE spill (user_id INTEGER PRIMARY KEY, state TEXT, data TEXT, touched REAL)")
+        return spill
+
+    def _key(self, key: StorageKey):
+        # Бот работает только в личке: chat_id == user_id, и запись можно хранить под одним int
+        if self._bot_id is None:
+            self._bot_id = key.bot_id
+        if (
+            key.bot_id == self._bot_id and key.chat_id == key.user_id and key.thread_id is None
+            and key.business_connection_id is None and key.destiny == "default"
+        ):
+            return key.user_id
+        return key
+
+    def _expired(self, record: FSMRecord, now: float) -> bool:
+        return now - record.touched > self.ttls.get(record.state, self.default_ttl)
+
+    def _load(self, key):
+        record = self._records.get(key)
+        if record is None and self.spilled and isinstance(key, int):
+            row = self._spill.execute("SELECT state, data, touched FROM spill WHERE user_id = ?", (key,)).fetchone()
+            if row is not None:
+                self._spill.execute("DELETE FROM spill WHERE user_id = ?", (key,))
+                self._spill.commit()
+                self.spilled -= 1
+                state, data, touched = row
+                record = self._records[key] = FSMRecord(state, json.loads(data) if data else None, touched)
+        if record is not None and self._expired(record, time.time()):
+            del self._records[key]
+            return None
+        return record
+
+    def _store(self, key, record: FSMRecord):
+        if record.state is None and not record.data:
+            self._records.pop(key, None)
+        else:
+            record.touched = time.time()
+            self._records[key] = record
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        key = self._key(key)
+        record = self._load(key) or FSMRecord(None, None, 0.0)
+        record.state = state
+        self._store(key, record)
+
+    async def get_state(self, key: StorageKey):
+        record = self._load(self._key(key))
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        key = self._key(key)
+        record = self._load(key) or FSMRecord(None, None, 0.0)
+        record.data = data.copy() if data else None
+        self._store(key, record)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        record = self._load(self._key(key))
+        return record.data.copy() if record and record.data else {}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            try:
+                now = time.time()
+                await _evict(self._records, lambda record: self._expired(record, now))
+                if self._spill is not None:
+                    await self._spill_idle(now)
+                    if now - self._spill_swept_at > self.default_ttl:
+                        self._spill_swept_at = now
+                        await self._sweep_spill(now)
+            except Exception as e:
+                logging.error(f"FSM storage sweep error: {e}")
+
+    async def _spill_idle(self, now: float, chunk: int = 10000):
+        idle = [
+            key for key, record in self._records.items()
+            if isinstance(key, int) and now - record.touched > self.spill_after
+        ]
+        for first in range(0, len(idle), chunk):
+            rows = []
+            for key in idle[first:first + chunk]:
+                record = self._records.get(key)
+                # Запись могла обновиться или удалиться, пока мы отдавали управление
+                if record is None or now - record.touched <= self.spill_after:
+                    continue
+                del self._records[key]
+                rows.append((key, record.state, json.dumps(record.data) if record.data else None, record.touched))
+            self._spill.executemany("INSERT OR REPLACE INTO spill VALUES (?, ?, ?, ?)", rows)
+            self._spill.commit()
+            self.spilled += len(rows)
+            await asyncio.sleep(0)
+
+    async def _sweep_spill(self, now: float):
+        # Кто так и не вернулся, лежит на диске до истечения TTL — раз в TTL чистим и файл.
+        # Освободившиеся страницы SQLite отдаёт следующим выгрузкам, так что файл не пухнет
+        deleted = 0
+        for state, ttl in self.ttls.items():
+            deleted += self._spill.execute(
+                "DELETE FROM spill WHERE state = ? AND touched < ?", (state, now - ttl),
+            ).rowcount
+        deleted += self._spill.execute(
+            f"DELETE FROM spill WHERE (state IS NULL OR state NOT IN ({', '.join('?' * len(self.ttls))})) AND touched < ?",
+            (*self.ttls, now - self.default_ttl),
+        ).rowcount
+        self._spill.commit()
+        self.spilled -= deleted
+
+# В Redis один TTL на всё (RedisStorage не умеет по состояниям), но без него ключи брошенных
+# онбордингов и оценок копились бы вечно. Redis принимает только целые секунды
+fsm_storage = RedisStorage(
+    redis, state_ttl=int(FSM_STATE_TTL), data_ttl=int(FSM_STATE_TTL),
+) if redis else CompactMemoryStorage(
+    FSM_STATE_TTLS, FSM_STATE_TTL, FSM_SPILL_PATH, FSM_SPILL_AFTER,
+)
+dp = Dispatcher(storage=fsm_storage)
+
+# === МЕТРИКИ ===
+# Пока METRICS_PORT не задан, метрики ничего не измеряют: middleware не подключается,
+# а все замеры в горячих местах стоят за проверкой METRICS_ENABLED.
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Время работы обработчика", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+DB_QUERY_LATENCY = Histogram("bot_db_query_seconds", "Время запроса к БД вместе с ожиданием соединения", ["query"])
+DB_QUERY_ERRORS = Counter("bot_db_query_errors_total", "Ошибки запросов к БД", ["query"])
+SEARCH_QUEUE_DEPTH = Gauge("bot_search_queue_depth", "Пользователей в поиске")
+ACTIVE_SESSIONS = Gauge("bot_active_sessions", "Активных диалогов")
+TIME_TO_MATCH = Histogram(
+    "bot_time_to_match_seconds", "Время от начала поиска до собеседника",
+    buckets=(0.1, 1, 5, 15, 30, 60, 120, 180, 300),
+)
+OUTBOX_DEPTH = Gauge("bot_outbox_depth", "Сообщений в очереди на отправку")
+OUTBOUND_LATENCY = Histogram("bot_outbound_seconds", "Время от постановки в очередь до отправки")
+OUTBOUND_ERRORS = Counter("bot_outbound_errors_total", "Сообщения, которые не удалось отправить")
+RELAY_DEPTH = Gauge("bot_relay_depth", "Сообщений в очередях пересылки")
+RELAY_LATENCY = Histogram("bot_relay_seconds", "Проверки и постановка в отправку одного сообщения или альбома")
+RELAY_ERRORS = Counter("bot_relay_errors_total", "Ошибки пересылки")
+RELAY_REJECTED = Counter("bot_relay_rejected_total", "Сообщения, не принятые в переполненную очередь пересылки")
+WORKER_QUEUE_DEPTH = Gauge("bot_worker_queue_depth", "Апдейтов и событий в очередях супервизора к воркерам")
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+async def _refresh_gauges():
+    while True:
+        try:
+            SEARCH_QUEUE_DEPTH.set(await state_backend.queue_size())
+            ACTIVE_SESSIONS.set(await state_backend.session_count())
+        except Exception as e:
+            logging.error(f"Metrics error: {e}")
+        await asyncio.sleep(5)
+
+metrics_task = None
+
+def start_metrics():
+    global metrics_task
+    if not METRICS_ENABLED or metrics_task is not None:
+        return
+    start_http_server(METRICS_PORT, METRICS_ADDR)
+    OUTBOX_DEPTH.set_function(lambda: len(outbox))
+    RELAY_DEPTH.set_function(lambda: len(relay))
+    WORKER_QUEUE_DEPTH.set_function(lambda: sum(map(len, supervisor.links)) if supervisor else 0)
+    metrics_task = asyncio.create_task(_refresh_gauges())
+    print(f"✅ Метрики на {METRICS_ADDR}:{METRICS_PORT}/metrics")
+
+if METRICS_ENABLED:
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+
 # === КЛАВИАТУРЫ ===
-def get_own_gender_kb():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Мужчина"), KeyboardButton(text="Женщина")]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+# Клавиатуры собираются один раз при импорте и дальше только переиспользуются — не изменяйте их.
+# Заранее сериализовать их в JSON не выйдет: aiogram валидирует reply_markup как модель
+# и сам сериализует весь метод при отправке
+OWN_GENDER_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Мужчина"), KeyboardButton(text="Женщина")]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
 
-def get_search_pref_kb():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Микс (любой)")],
-            [KeyboardButton(text="Только парни")],
-            [KeyboardButton(text="Только девушки")],
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+SEARCH_PREF_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Микс (любой)")],
+        [KeyboardButton(text="Только парни")],
+        [KeyboardButton(text="Только девушки")],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
 
-def get_search_kb():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="/stop")]],
-        resize_keyboard=True
-    )
+SEARCH_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="/stop")]],
+    resize_keyboard=True
+)
 
-def get_chat_kb():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="/next"), KeyboardButton(text="/stop"), KeyboardButton(text="/link")]
-        ],
-        resize_keyboard=True
-    )
+CHAT_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/next"), KeyboardButton(text="/stop"), KeyboardButton(text="/link")]
+    ],
+    resize_keyboard=True
+)
 
-def get_idle_kb():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="/search"), KeyboardButton(text="/gender")]
-        ],
-        resize_keyboard=True
-    )
+IDLE_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/search"), KeyboardButton(text="/gender")]
+    ],
+    resize_keyboard=True
+)
 
-def get_link_confirm_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Отправить", callback_data="link_confirm_yes")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="link_confirm_no")]
-    ])
+LINK_CONFIRM_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Отправить", callback_data="link_confirm_yes")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="link_confirm_no")]
+])
 
+REMOVE_KB = types.ReplyKeyboardRemove()
+
+# Без кэша: кнопки оценки получают по одному разу в конце каждого диалога, и id собеседника
+# почти не повторяется — кэш только держал бы память, не давая попаданий
 def get_rating_kb(partner_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👍 Хороший", callback_data=f"rate_{partner_id}_1")],
         [InlineKeyboardButton(text="👎 Неадекват", callback_data=f"rate_{partner_id}_0")]
     ])
 
-# === ГЛОБАЛЬНЫЕ ДАННЫЕ ===
-search_queue = set()
-active_sessions = {}
+# === ТЕКСТЫ ===
+SEARCH_TARGETS = {"male": "парня", "female": "девушку", "any": "собеседника"}
+BANNED_TEXT = "⚠️ Вы забанены. Осталось: {}"
+CAPTCHA_TEXT = "Выберите смайлик: ({})\nВарианты: {}"
+CAPTCHA_RETRY_TEXT = "Неверно! Попытка {}/3\n" + CAPTCHA_TEXT
+CAPTCHA_EMOJIS = ("🍎", "🚗", "😊", "🐱", "🌈", "🍕", "🚀", "⚽", "🎮", "📚")
+MATCH_TEXT = "✅ Собеседник найден, хорошего общения🫶🏻\n/next - следующий собеседник\n/stop - остановить диалог"
+PARTNER_LEFT_TEXT = "Ваш собеседник покинул чат 😔"
+IN_SEARCH_TEXT = "Вы в поиске собеседника. Подождите..."
+CHOOSE_ACTION_TEXT = "Выберите действие:"
+RELAY_BUSY_TEXT = "⚠️ Слишком много сообщений подряд — это не доставлено. Подождите немного."
 
-# === БЕЗОПАСНОСТЬ ===
-user_command_count = defaultdict(list)
-user_captcha_attempts = defaultdict(int)
-captcha_challenges = {}
+# === ПОДБОР СОБЕСЕДНИКОВ ===
+GENDERS = ("male", "female")
+PREFERENCES = ("male", "female", "any")
 
-# === ФУНКЦИИ РАБОТЫ С БД ===
-async def init_db():
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute("""
+def is_compatible(a: tuple, b: tuple) -> bool:
+    # Ключ корзины — (свой пол, кого ищет); пара подходит, только если устраивает обоих
+    return a[1] in ("any", b[0]) and b[1] in ("any", a[0])
+
+def fifo_policy(heads: list) -> tuple:
+    # Первая непустая корзина в порядке приоритета (сначала те, кто ищет именно нас)
+    return heads[0]
+
+def longest_waiting_policy(heads: list) -> tuple:
+    # Тот, кто ждёт дольше всех среди голов подходящих корзин
+    return min(heads)
+
+MATCH_POLICIES = {
+    "fifo": fifo_policy,
+    "longest_waiting": longest_waiting_policy,
+}
+
+# Репутация делит очередь на уровни по доле 👎 среди оценок. С режимом off уровни
+# всё равно есть, но ищем сразу во всех; prefer — сначала свой уровень, потом соседние;
+# isolate — пользователи с плохой репутацией видят только друг друга
+TIER_LOW, TIER_NORMAL, TIER_HIGH = 0, 1, 2
+TIERS = (TIER_LOW, TIER_NORMAL, TIER_HIGH)
+
+def reputation_tier(good: int, bad: int) -> int:
+    votes = good + bad
+    if votes < REPUTATION_MIN_VOTES:
+        return TIER_NORMAL
+    if bad >= votes * REPUTATION_LOW_SHARE:
+        return TIER_LOW
+    if bad <= votes * REPUTATION_HIGH_SHARE:
+        return TIER_HIGH
+    return TIER_NORMAL
+
+def tier_groups(tier: int, mode: str) -> list:
+    """Уровни, в которых ищем пару, группами по убыванию приоритета."""
+    if mode == "prefer":
+        return [
+            [other for other in TIERS if abs(other - tier) == distance]
+            for distance in range(len(TIERS))
+            if any(abs(other - tier) == distance for other in TIERS)
+        ]
+    if mode == "isolate":
+        if tier == TIER_LOW:
+            return [[TIER_LOW]]
+        return [[tier], [other for other in TIERS if other not in (tier, TIER_LOW)]]
+    return [list(TIERS)]
+
+if REPUTATION_MODE not in ("off", "prefer", "isolate"):
+    raise ValueError(f"❌ Неизвестный REPUTATION_MODE: {REPUTATION_MODE}")
+
+PAIRS = [(g, p) for g in GENDERS for p in PREFERENCES]
+COMPATIBLE_PAIRS = {
+    key: sorted(
+        (other for other in PAIRS if is_compatible(key, other)),
+        key=lambda other: other[1] == "any",
+    )
+    for key in PAIRS
+}
+# Ключ корзины — (свой пол, кого ищет, уровень репутации). Список кандидатов считается один раз:
+# группы корзин, внутри группы — сначала те, кто ищет именно нас
+BUCKETS = [(g, p, t) for g, p in PAIRS for t in TIERS]
+CANDIDATE_BUCKETS = {
+    (g, p, t): [
+        [(og, op, ot) for ot in group for og, op in COMPATIBLE_PAIRS[(g, p)]]
+        for group in tier_groups(t, REPUTATION_MODE)
+    ]
+    for g, p, t in BUCKETS
+}
+
+class Matchmaker:
+    def __init__(self, policy=fifo_policy):
+        self.policy = policy
+        self._buckets = {key: OrderedDict() for key in BUCKETS}
+        self._entries = {}
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def preference(self, user_id: int):
+        key = self._entries.get(user_id)
+        return key[1] if key else None
+
+    def enqueue(self, user_id: int, own_gender: str, pref: str, tier: int = TIER_NORMAL, now: float = None):
+        """Ставит пользователя в очередь или сразу возвращает (id пары, сколько она ждала)."""
+        if user_id in self._entries:
+            return None
+        key = (own_gender, pref, tier)
+        if now is None:
+            now = time.time()
+        # Политика выбирает среди голов первой группы, где кто-то есть
+        for group in CANDIDATE_BUCKETS[key]:
+            heads = []
+            for other in group:
+                bucket = self._buckets[other]
+                if bucket:
+                    candidate, enqueued_at = next(iter(bucket.items()))
+                    heads.append((enqueued_at, candidate))
+            if heads:
+                enqueued_at, partner_id = self.policy(heads)
+                self.discard(partner_id)
+                return partner_id, now - enqueued_at
+        self._buckets[key][user_id] = now
+        self._entries[user_id] = key
+        return None
+
+    def discard(self, user_id: int) -> bool:
+        key = self._entries.pop(user_id, None)
+        if key is None:
+            return False
+        del self._buckets[key][user_id]
+        return True
+
+    def enqueued_at(self, user_id: int):
+        key = self._entries.get(user_id)
+        return self._buckets[key][user_id] if key else None
+
+    def items(self):
+        """(user_id, корзина, время постановки) в порядке очередей."""
+        for key, bucket in self._buckets.items():
+            for user_id, enqueued_at in bucket.items():
+                yield user_id, key, enqueued_at
+
+    def restore(self, user_id: int, key: tuple, enqueued_at: float):
+        self.discard(user_id)
+        self._buckets[key][user_id] = enqueued_at
+        self._entries[user_id] = key
+
+# === ТАЙМЕРЫ ===
+class TimerWheel:
+    """Хэшированное колесо таймеров: schedule/cancel за O(1), одна задача на все дедлайны."""
+
+    def __init__(self, tick: float = 1.0, slots: int = 512):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]
+        self._timers = {}
+        self._cursor = 0
+        self._task = None
+        self._running = set()
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def schedule(self, key, delay: float, callback, *args):
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        index = (self._cursor + ticks) % len(self._slots)
+        # Сколько раз колесо пройдёт мимо слота, прежде чем таймер сработает
+        rounds = (ticks - 1) // len(self._slots)
+        self._slots[index][key] = [rounds, callback, args]
+        self._timers[key] = index
+
+    def cancel(self, key) -> bool:
+        index = self._timers.pop(key, None)
+        if index is None:
+            return False
+        del self._slots[index][key]
+        return True
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._running, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            # Если цикл событий отстал, догоняем все пропущенные тики
+            while next_tick <= loop.time():
+                next_tick += self.tick
+                self._advance()
+
+    def _advance(self):
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        slot = self._slots[self._cursor]
+        expired = []
+        for key, timer in slot.items():
+            if timer[0]:
+                timer[0] -= 1
+            else:
+                expired.append(key)
+        for key in expired:
+            _, callback, args = slot.pop(key)
+            del self._timers[key]
+            task = asyncio.create_task(self._fire(callback, args))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    @staticmethod
+    async def _fire(callback, args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logging.error(f"Timer error: {e}")
+
+timers = TimerWheel()
+
+# === ИСХОДЯЩИЕ СООБЩЕНИЯ ===
+PRIORITY_RELAY = 0
+PRIORITY_SYSTEM = 1
+PRIORITY_MODERATION = 2
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        # Уводим ведро в минус так, чтобы следующий токен появился ровно через seconds
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+class OutboundJob:
+    __slots__ = ("chat_id", "call", "priority", "seq", "future", "attempts", "enqueued_at")
+
+    def __init__(self, chat_id: int, call, priority: int, seq: int):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+
+class ChatOutbox:
+    __slots__ = ("jobs", "bucket", "scheduled")
+
+    def __init__(self, rate: float, burst: int):
+        self.jobs = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.scheduled = False
+
+class Outbox:
+    """Единая очередь отправки: общий лимит бота, лимит на чат, приоритеты и повтор после RetryAfter.
+
+    Внутри одного чата сообщения уходят строго по порядку и по одному; приоритет решает,
+    какой из готовых чатов получит следующий токен общего лимита.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._ready = []
+        self._sleeping = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
+        self.depth = 0
+        self.stats = {"sent": 0, "failed": 0, "retried": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+    def __len__(self) -> int:
+        return self.depth
+
+    def submit(self, chat_id: int, call, priority: int = PRIORITY_SYSTEM) -> asyncio.Future:
+        """Ставит вызов API в очередь; future получит результат или None при ошибке."""
+        job = OutboundJob(chat_id, call, priority, next(self._seq))
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatOutbox(self.chat_rate, self.chat_burst)
+        chat.jobs.append(job)
+        self.depth += 1
+        if not chat.scheduled:
+            self._schedule(chat_id, chat, time.monotonic())
+        return job.future
+
+    def latency_avg(self) -> float:
+        return self.stats["latency_total"] / self.stats["sent"] if self.stats["sent"] else 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        # Даём очереди немного времени разойтись, затем останавливаем отправку
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._sending, return_exceptions=True)
+            self._task = None
+
+    def _schedule(self, chat_id: int, chat: ChatOutbox, now: float):
+        chat.scheduled = True
+        delay = chat.bucket.delay(now)
+        if delay:
+            heapq.heappush(self._sleeping, (now + delay, chat_id))
+        else:
+            head = chat.jobs[0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        self._wakeup.set()
+
+    async def _run(self):
+        last_cleanup = time.monotonic()
+        while True:
+            now = time.monotonic()
+            while self._sleeping and self._sleeping[0][0] <= now:
+                _, chat_id = heapq.heappop(self._sleeping)
+                self._schedule(chat_id, self._chats[chat_id], now)
+            wait = self._sleeping[0][0] - now if self._sleeping else None
+            if self._ready:
+                global_delay = self._global.delay(now)
+                if not global_delay:
+                    self._dispatch(heapq.heappop(self._ready)[2])
+                    continue
+                wait = global_delay if wait is None else min(wait, global_delay)
+            if now - last_cleanup > 60:
+                last_cleanup = now
+                self._cleanup(now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, chat_id: int):
+        chat = self._chats[chat_id]
+        job = chat.jobs.popleft()
+        self._global.take()
+        chat.bucket.take()
+        task = asyncio.create_task(self._send(chat, job))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat: ChatOutbox, job: OutboundJob):
+        retry_after = None
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            retry_after = e.retry_after
+        except TelegramNetworkError:
+            retry_after = 1
+        except Exception as e:
+            logging.error(f"Send error to {job.chat_id}: {e}")
+            self._finish(job, None, failed=True)
+        else:
+            self._finish(job, result)
+        if retry_after is not None:
+            job.attempts += 1
+            if job.attempts > OUTBOX_MAX_RETRIES:
+                logging.error(f"Send to {job.chat_id} dropped after {job.attempts} attempts")
+                self._finish(job, None, failed=True)
+            else:
+                self.stats["retried"] += 1
+                chat.bucket.pause(retry_after)
+                chat.jobs.appendleft(job)
+        chat.scheduled = False
+        if chat.jobs:
+            self._schedule(job.chat_id, chat, time.monotonic())
+
+    def _finish(self, job: OutboundJob, result, failed: bool = False):
+        self.depth -= 1
+        latency = time.monotonic() - job.enqueued_at
+        if failed:
+            self.stats["failed"] += 1
+            if METRICS_ENABLED:
+                OUTBOUND_ERRORS.inc()
+        else:
+            self.stats["sent"] += 1
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+            if METRICS_ENABLED:
+                OUTBOUND_LATENCY.observe(latency)
+        if not job.future.done():
+            job.future.set_result(result)
+
+    def _cleanup(self, now: float):
+        # Чат без очереди с полным ведром ничем не отличается от нового — его можно забыть
+        idle = [
+            chat_id for chat_id, chat in self._chats.items()
+            if not chat.scheduled and not chat.jobs and not chat.bucket.delay(now)
+            and chat.bucket.tokens >= chat.bucket.capacity
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+# Общий лимит бота делится поровну между инстансами, а внутри инстанса — между воркерами
+outbox = Outbox(
+    OUTBOX_GLOBAL_RATE / INSTANCES / (WORKERS if IS_WORKER else 1), OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST
+)
+
+# === МОДЕРАЦИЯ ===
+# Фото и видео можно собрать в альбом, остальное пересылается по одному
+GROUPABLE_MEDIA = ("photo", "video")
+MEDIA_GROUP_SIZE = 10
+
+class ModerationItem:
+    __slots__ = ("kind", "file_id", "user_id", "message_id")
+
+    def __init__(self, kind: str, file_id: str, user_id: int, message_id: int):
+        self.kind = kind
+        self.file_id = file_id
+        self.user_id = user_id
+        self.message_id = message_id
+
+class ModerationPipeline:
+    """Фоновая пересылка медиа в канал модерации.
+
+    Повторы одного и того же файла (по file_unique_id) отсекаются ограниченным LRU-множеством,
+    фото и видео уходят альбомами, а при растущем хвосте часть медиа отбрасывается случайно,
+    чтобы канал модерации никогда не тормозил пересылку собеседнику.
+    """
+
+    def __init__(self, channel_id: int, seen_size: int, window: float, backlog_limit: int):
+        self.channel_id = channel_id
+        self.seen_size = seen_size
+        self.window = window
+        self.backlog_limit = backlog_limit
+        self._queue = deque()
+        self._seen = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._in_flight = 0
+        self.stats = {"queued": 0, "duplicates": 0, "sampled_out": 0, "forwarded": 0}
+
+    def __len__(self) -> int:
+        return len(self._queue) + self._in_flight
+
+    def submit(self, kind: str, file_id: str, file_unique_id: str, user_id: int, message_id: int) -> bool:
+        """Ставит медиа в очередь; False — файл уже видели или он не прошёл выборку."""
+        if file_unique_id in self._seen:
+            self._seen.move_to_end(file_unique_id)
+            self.stats["duplicates"] += 1
+            return False
+        # Когда хвост больше лимита, оставляем каждый элемент с вероятностью limit / хвост,
+        # так что в среднем в канал уходит не больше, чем он успевает принять.
+        # Отброшенный файл не запоминаем: следующая его копия получит ещё один шанс
+        backlog = len(self)
+        if backlog >= self.backlog_limit and random.random() >= self.backlog_limit / backlog:
+            self.stats["sampled_out"] += 1
+            return False
+        self._seen[file_unique_id] = None
+        if len(self._seen) > self.seen_size:
+            self._seen.popitem(last=False)
+        self._queue.append(ModerationItem(kind, file_id, user_id, message_id))
+        self.stats["queued"] += 1
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Остаток отдаём в outbox без ожидания окна — он сам постарается дослать его до остановки
+        self._drain()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Небольшое окно, чтобы успели подтянуться соседние фото и видео для альбома
+            await asyncio.sleep(self.window)
+            self._wakeup.clear()
+            self._drain()
+
+    def _drain(self):
+        group = []
+        while self._queue:
+            item = self._queue.popleft()
+            if item.kind not in GROUPABLE_MEDIA:
+                self._send(partial(bot.forward_message, self.channel_id, item.user_id, item.message_id), 1)
+                continue
+            group.append(item)
+            if len(group) == MEDIA_GROUP_SIZE:
+                self._send_group(group)
+                group = []
+        if group:
+            self._send_group(group)
+
+    def _send_group(self, group: list):
+        if len(group) == 1:
+            item = group[0]
+            self._send(partial(bot.forward_message, self.channel_id, item.user_id, item.message_id), 1)
+            return
+        # В альбоме автор не виден, поэтому id отправителя пишем в подпись каждого элемента
+        media = [
+            InputMediaPhoto(media=item.file_id, caption=f"👤 {item.user_id}") if item.kind == "photo"
+            else InputMediaVideo(media=item.file_id, caption=f"👤 {item.user_id}")
+            for item in group
+        ]
+        self._send(partial(bot.send_media_group, self.channel_id, media), len(group))
+
+    def _send(self, call, count: int):
+        self._in_flight += count
+        future = outbox.submit(self.channel_id, call, PRIORITY_MODERATION)
+        future.add_done_callback(partial(self._sent, count))
+
+    def _sent(self, count: int, future: asyncio.Future):
+        self._in_flight -= count
+        if not future.cancelled() and future.result() is not None:
+            self.stats["forwarded"] += count
+
+moderation = ModerationPipeline(CHANNEL_ID, MODERATION_SEEN_SIZE, MODERATION_BATCH_WINDOW, MODERATION_BACKLOG_LIMIT)
+
+# === ХРАНИЛИЩЕ СОСТОЯНИЯ ===
+class RateRecord:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    """Token bucket на пользователя: limit команд за window секунд, проверка за O(1).
+
+    Пользователь с полным ведром неотличим от нового, поэтому такие записи
+    можно выбрасывать — их и убирает sweep().
+    """
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.rate = limit / window
+        self._records = {}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def hit(self, user_id: int, now: float) -> bool:
+        record = self._records.get(user_id)
+        if record is None:
+            record = self._records[user_id] = RateRecord(self.limit, now)
+        else:
+            record.tokens = min(self.limit, record.tokens + (now - record.updated) * self.rate)
+            record.updated = now
+        if record.tokens < 1:
+            return True
+        record.tokens -= 1
+        return False
+
+    def reset(self, user_id: int):
+        self._records.pop(user_id, None)
+
+    async def sweep(self, now: float) -> int:
+        return await _evict(self._records, lambda record: record.tokens + (now - record.updated) * self.rate >= self.limit)
+
+class CaptchaRecord:
+    __slots__ = ("correct", "attempts", "expires_at")
+
+    def __init__(self, correct, attempts: int, expires_at: float):
+        self.correct = correct
+        self.attempts = attempts
+        self.expires_at = expires_at
+
+async def _evict(items: dict, is_stale, chunk: int = 10000) -> int:
+    """Удаляет устаревшие записи порциями, не блокируя цикл событий на больших словарях."""
+    stale = []
+    for i, (key, value) in enumerate(list(items.items()), 1):
+        if is_stale(value):
+            stale.append(key)
+        if i % chunk == 0:
+            await asyncio.sleep(0)
+    for key in stale:
+        value = items.get(key)
+        # Запись могла обновиться, пока мы отдавали управление
+        if value is not None and is_stale(value):
+            del items[key]
+    return len(stale)
+
+class MemoryStateBackend:
+    """Очередь поиска, сессии, лимиты и капча в памяти одного процесса."""
+
+    def __init__(self, policy: str, snapshots=None):
+        self.queue = Matchmaker(MATCH_POLICIES[policy])
+        self.sessions = {}
+        self.rate_limiter = RateLimiter(RATE_LIMIT, RATE_WINDOW)
+        self.captcha = {}
+        self.snapshots = snapshots
+        self._sweeper = None
+
+    def restore(self) -> set:
+        """Поднимает очередь и сессии из снимка и журнала; возвращает id тех, кого восстановить не удалось."""
+        if self.snapshots is None:
+            return set()
+        return self.snapshots.restore(self)
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep())
+        if self.snapshots is not None:
+            self.snapshots.start(self)
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        if self.snapshots is not None:
+            await self.snapshots.close(self)
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            now = time.monotonic()
+            await self.rate_limiter.sweep(now)
+            await _evict(self.captcha, lambda record: record.expires_at <= now)
+
+    async def enqueue(self, user_id: int, own_gender: str, pref: str, tier: int = TIER_NORMAL, now: float = None):
+        """Ставит в очередь или атомарно создаёт сессию и возвращает (id собеседника, его ожидание).
+
+        now становится временем постановки — по нему таймеры поиска узнают «свой» поиск."""
+        if user_id in self.sessions or user_id in self.queue:
+            return None
+        match = self.queue.enqueue(user_id, own_gender, pref, tier, now)
+        if match is not None:
+            partner_id = match[0]
+            self.sessions[user_id] = partner_id
+            self.sessions[partner_id] = user_id
+            if self.snapshots is not None:
+                self.snapshots.log("M", user_id, partner_id)
+        elif self.snapshots is not None:
+            self.snapshots.log("E", user_id, own_gender, pref, self.queue.enqueued_at(user_id), tier)
+        return match
+
+    async def dequeue(self, user_id: int, enqueued_at: float = None) -> bool:
+        """Убирает из очереди; с enqueued_at — только если это всё ещё тот же поиск."""
+        if enqueued_at is not None and self.queue.enqueued_at(user_id) != enqueued_at:
+            return False
+        removed = self.queue.discard(user_id)
+        if removed and self.snapshots is not None:
+            self.snapshots.log("D", user_id)
+        return removed
+
+    async def is_searching(self, user_id: int) -> bool:
+        return user_id in self.queue
+
+    async def search_preference(self, user_id: int):
+        return self.queue.preference(user_id)
+
+    async def enqueued_at(self, user_id: int):
+        return self.queue.enqueued_at(user_id)
+
+    async def queue_size(self) -> int:
+        return len(self.queue)
+
+    async def get_partner(self, user_id: int):
+        return self.sessions.get(user_id)
+
+    async def end_session(self, user_id: int):
+        partner_id = self.sessions.pop(user_id, None)
+        if partner_id is not None and self.sessions.get(partner_id) == user_id:
+            del self.sessions[partner_id]
+        if partner_id is not None and self.snapshots is not None:
+            self.snapshots.log("S", user_id, partner_id)
+        return partner_id
+
+    async def session_count(self) -> int:
+        return len(self.sessions) // 2
+
+    async def is_rate_limited(self, user_id: int) -> bool:
+        return self.rate_limiter.hit(user_id, time.monotonic())
+
+    def _captcha(self, user_id: int):
+        record = self.captcha.get(user_id)
+        if record is not None and record.expires_at <= time.monotonic():
+            del self.captcha[user_id]
+            return None
+        return record
+
+    async def set_captcha(self, user_id: int, correct: str, reset_attempts: bool):
+        record = self._captcha(user_id)
+        attempts = 0 if reset_attempts or record is None else record.attempts
+        self.captcha[user_id] = CaptchaRecord(correct, attempts, time.monotonic() + CAPTCHA_TTL)
+
+    async def get_captcha(self, user_id: int):
+        record = self._captcha(user_id)
+        return record.correct if record else None
+
+    async def fail_captcha(self, user_id: int) -> int:
+        record = self._captcha(user_id)
+        if record is None:
+            record = self.captcha[user_id] = CaptchaRecord(None, 0, time.monotonic() + CAPTCHA_TTL)
+        record.attempts += 1
+        return record.attempts
+
+    async def pass_captcha(self, user_id: int):
+        self.captcha.pop(user_id, None)
+        self.rate_limiter.reset(user_id)
+
+# Сопоставление делается одним Lua-скриптом, поэтому два воркера не могут
+# забрать одного и того же кандидата.
+REDIS_ENQUEUE = """
+local searching, sessions, own = KEYS[1], KEYS[2], KEYS[3]
+local user, bucket, now, policy = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+if redis.call('HEXISTS', searching, user) == 1 or redis.call('HEXISTS', sessions, user) == 1 then
+    return false
+end
+-- ARGV[5..] — номера ключей, на которых заканчиваются группы уровней репутации
+local group_ends = {}
+for i = 5, #ARGV do
+    group_ends[tonumber(ARGV[i])] = true
+end
+local best_key, best_member, best_score, best_raw
+for i = 4, #KEYS do
+    local head = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+    if head[1] then
+        local score = tonumber(head[2])
+        if not best_key or score < best_score then
+            best_key, best_member, best_score, best_raw = KEYS[i], head[1], score, head[2]
+        end
+        if policy ~= 'longest_waiting' then
+            break
+        end
+    end
+    if best_key and group_ends[i] then
+        break
+    end
+end
+if best_key then
+    redis.call('ZREM', best_key, best_member)
+    redis.call('HDEL', searching, best_member)
+    redis.call('HSET', sessions, user, best_member, best_member, user)
+    return {best_member, best_raw}
+end
+redis.call('ZADD', own, now, user)
+redis.call('HSET', searching, user, bucket)
+return false
+"""
+
+# ARGV[3] — необязательное время постановки: чужой (более поздний) поиск не трогаем
+REDIS_DEQUEUE = """
+local bucket = redis.call('HGET', KEYS[1], ARGV[1])
+if not bucket then
+    return 0
+end
+if ARGV[3] and tonumber(redis.call('ZSCORE', ARGV[2] .. bucket, ARGV[1])) ~= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', ARGV[2] .. bucket, ARGV[1])
+return 1
+"""
+
+REDIS_END_SESSION = """
+local partner = redis.call('HGET', KEYS[1], ARGV[1])
+if not partner then
+    return false
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('HGET', KEYS[1], partner) == ARGV[1] then
+    redis.call('HDEL', KEYS[1], partner)
+end
+return partner
+"""
+
+REDIS_RATE_LIMIT = """
+local now, window, limit = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 1
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('EXPIRE', KEYS[1], window)
+return 0
+"""
+
+class RedisStateBackend:
+    """Общее для нескольких воркеров состояние в Redis."""
+
+    def __init__(self, client: Redis, prefix: str, policy: str):
+        self.redis = client
+        self.policy = policy
+        self.searching_key = f"{prefix}:searching"
+        self.sessions_key = f"{prefix}:sessions"
+        self.queue_prefix = f"{prefix}:queue:"
+        self.prefix = prefix
+        self._enqueue = client.register_script(REDIS_ENQUEUE)
+        self._dequeue = client.register_script(REDIS_DEQUEUE)
+        self._end_session = client.register_script(REDIS_END_SESSION)
+        self._rate_limit = client.register_script(REDIS_RATE_LIMIT)
+
+    def _bucket_key(self, bucket: tuple) -> str:
+        return f"{self.queue_prefix}{bucket[0]}:{bucket[1]}:{bucket[2]}"
+
+    def start(self):
+        pass
+
+    async def close(self):
+        await self.redis.aclose()
+
+    async def enqueue(self, user_id: int, own_gender: str, pref: str, tier: int = TIER_NORMAL, now: float = None):
+        bucket = (own_gender, pref, tier)
+        keys = [self.searching_key, self.sessions_key, self._bucket_key(bucket)]
+        group_ends = []
+        for group in CANDIDATE_BUCKETS[bucket]:
+            keys += [self._bucket_key(other) for other in group]
+            group_ends.append(len(keys))
+        if now is None:
+            now = time.time()
+        match = await self._enqueue(
+            keys=keys,
+            args=[user_id, f"{own_gender}:{pref}:{tier}", now, self.policy, *group_ends],
+        )
+        if not match:
+            return None
+        partner_id, enqueued_at = match
+        return int(partner_id), now - float(enqueued_at)
+
+    async def dequeue(self, user_id: int, enqueued_at: float = None) -> bool:
+        args = [user_id, self.queue_prefix]
+        if enqueued_at is not None:
+            args.append(enqueued_at)
+        return bool(await self._dequeue(keys=[self.searching_key], args=args))
+
+    async def is_searching(self, user_id: int) -> bool:
+        return bool(await self.redis.hexists(self.searching_key, user_id))
+
+    async def search_preference(self, user_id: int):
+        bucket = await self.redis.hget(self.searching_key, user_id)
+        return bucket.split(":")[1] if bucket else None
+
+    async def enqueued_at(self, user_id: int):
+        bucket = await self.redis.hget(self.searching_key, user_id)
+        if not bucket:
+            return None
+        return await self.redis.zscore(self.queue_prefix + bucket, user_id)
+
+    async def queue_size(self) -> int:
+        return await self.redis.hlen(self.searching_key)
+
+    async def get_partner(self, user_id: int):
+        partner_id = await self.redis.hget(self.sessions_key, user_id)
+        return int(partner_id) if partner_id else None
+
+    async def end_session(self, user_id: int):
+        partner_id = await self._end_session(keys=[self.sessions_key], args=[user_id])
+        return int(partner_id) if partner_id else None
+
+    async def session_count(self) -> int:
+        return await self.redis.hlen(self.sessions_key) // 2
+
+    async def is_rate_limited(self, user_id: int) -> bool:
+        return bool(await self._rate_limit(
+            keys=[f"{self.prefix}:rate:{user_id}"],
+            args=[time.time(), RATE_WINDOW, RATE_LIMIT, time.time_ns()],
+        ))
+
+    async def set_captcha(self, user_id: int, correct: str, reset_attempts: bool):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(f"{self.prefix}:captcha:{user_id}", correct, ex=CAPTCHA_TTL)
+            if reset_attempts:
+                pipe.delete(f"{self.prefix}:captcha_attempts:{user_id}")
+            await pipe.execute()
+
+    async def get_captcha(self, user_id: int):
+        return await self.redis.get(f"{self.prefix}:captcha:{user_id}")
+
+    async def fail_captcha(self, user_id: int) -> int:
+        key = f"{self.prefix}:captcha_attempts:{user_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.expire(key, CAPTCHA_TTL)
+            attempts, _ = await pipe.execute()
+        return attempts
+
+    async def pass_captcha(self, user_id: int):
+        await self.redis.delete(
+            f"{self.prefix}:captcha:{user_id}",
+            f"{self.prefix}:captcha_attempts:{user_id}",
+            f"{self.prefix}:rate:{user_id}",
+        )
+
+# === СНИМКИ СОСТОЯНИЯ ===
+class StateSnapshots:
+    """Периодические бинарные снимки очереди и сессий плюс журнал изменений между ними.
+
+    Журнал — текстовые строки: E (встал в поиск), D (вышел из поиска), M (пара найдена),
+    S (диалог завершён). Каждый снимок начинает новое поколение журнала: snapshot хранит
+    номер поколения, а при старте проигрываются только журналы этого поколения и новее.
+    Записи журнала — присваивания, поэтому повторное проигрывание не портит состояние.
+    """
+
+    HEADER = struct.Struct("<4sQdII")
+    MAGIC = b"ACS2"
+    # В ACS1 корзины были без уровня репутации — читаем их как обычный уровень
+    BUCKETS_V1 = [(g, p, TIER_NORMAL) for g, p in PAIRS]
+
+    def __init__(self, directory: str, interval: float):
+        self.directory = directory
+        self.interval = interval
+        self.snapshot_path = os.path.join(directory, "snapshot.bin")
+        self.generation = 0
+        self.dirty = False
+        self._journal = None
+        self._task = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _journal_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"journal.{generation}")
+
+    def _journals(self) -> list:
+        found = []
+        for name in os.listdir(self.directory):
+            prefix, _, suffix = name.partition(".")
+            if prefix == "journal" and suffix.isdigit():
+                found.append(int(suffix))
+        return sorted(found)
+
+    def log(self, *fields):
+        if self._journal is None:
+            return
+        self._journal.write(" ".join(map(str, fields)) + "\n")
+        # Без fsync: от падения процесса защищает flush, от падения машины — снимки
+        self._journal.flush()
+        self.dirty = True
+
+    # --- восстановление ---
+    def restore(self, backend) -> set:
+        started = time.perf_counter()
+        lost = set()
+        if os.path.exists(self.snapshot_path):
+            try:
+                self._load_snapshot(backend)
+            except (OSError, ValueError, struct.error) as e:
+                logging.error(f"Snapshot error: {e}")
+                backend.sessions.clear()
+                backend.queue = Matchmaker(backend.queue.policy)
+        for generation in self._journals():
+            if generation < self.generation:
+                os.remove(self._journal_path(generation))
+                continue
+            with open(self._journal_path(generation), encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    # Строка без перевода строки — оборванная запись при падении
+                    if not line.endswith("\n") or not self._replay(backend, line.split()):
+                        user_ids = self._line_users(line)
+                        if not user_ids:
+                            logging.warning(f"Dropped unreadable journal line: {line!r}")
+                        lost.update(user_ids)
+            self.generation = max(self.generation, generation)
+        # Разорванные пары (a → b, но b → не a) не восстанавливаем
+        for user_id, partner_id in list(backend.sessions.items()):
+            if backend.sessions.get(partner_id) != user_id:
+                lost.update((user_id, partner_id))
+        for user_id in list(lost):
+            backend.queue.discard(user_id)
+            partner_id = backend.sessions.pop(user_id, None)
+            if partner_id is not None and backend.sessions.get(partner_id) == user_id:
+                del backend.sessions[partner_id]
+                lost.add(partner_id)
+        # Сразу фиксируем восстановленное состояние новым снимком, чтобы не дописывать
+        # в журнал с оборванной строкой и не проигрывать его повторно
+        self._write(self._rotate(backend))
+        self._remove_old_journals()
+        logging.info(
+            f"State restored in {time.perf_counter() - started:.3f}s: "
+            f"{len(backend.sessions) // 2} sessions, {len(backend.queue)} searching, {len(lost)} lost"
+        )
+        return lost
+
+    def _load_snapshot(self, backend):
+        with open(self.snapshot_path, "rb") as f:
+            data = f.read()
+        magic, generation, _, pairs_count, queue_count = self.HEADER.unpack_from(data)
+        if magic == self.MAGIC:
+            keys = BUCKETS
+        elif magic == b"ACS1":
+            keys = self.BUCKETS_V1
+        else:
+            raise ValueError("bad snapshot magic")
+        offset = self.HEADER.size
+        pairs, offset = self._read_array(data, offset, "q", pairs_count * 2)
+        user_ids, offset = self._read_array(data, offset, "q", queue_count)
+        enqueued, offset = self._read_array(data, offset, "d", queue_count)
+        buckets, offset = self._read_array(data, offset, "b", queue_count)
+        it = iter(pairs)
+        for user_id, partner_id in zip(it, it):
+            backend.sessions[user_id] = partner_id
+            backend.sessions[partner_id] = user_id
+        for user_id, enqueued_at, bucket in zip(user_ids, enqueued, buckets):
+            backend.queue.restore(user_id, keys[bucket], enqueued_at)
+        self.generation = generation
+
+    @staticmethod
+    def _read_array(data: bytes, offset: int, typecode: str, count: int):
+        values = array(typecode)
+        end = offset + values.itemsize * count
+        if end > len(data):
+            raise ValueError("truncated snapshot")
+        values.frombytes(data[offset:end])
+        return values, end
+
+    @staticmethod
+    def _line_users(line: str) -> set:
+        """id из полей-идентификаторов непроигранной строки; время и уровень в строке тоже числа, их не берём."""
+        fields = line.split()
+        end = {"E": 2, "D": 2, "M": 3, "S": 3}.get(fields[0] if fields else None, 1)
+        if not line.endswith("\n"):
+            # У оборванной строки последнее поле могло обрезаться посреди числа
+            end = min(end, len(fields) - 1)
+        user_ids = fields[1:end]
+        if not all(field.isdigit() for field in user_ids):
+            return set()
+        return {int(field) for field in user_ids}
+
+    @staticmethod
+    def _replay(backend, fields: list) -> bool:
+        try:
+            op = fields[0]
+            if op == "E":
+                tier = int(fields[5]) if len(fields) > 5 else TIER_NORMAL
+                backend.queue.restore(int(fields[1]), (fields[2], fields[3], tier), float(fields[4]))
+            elif op == "D":
+                backend.queue.discard(int(fields[1]))
+            elif op == "M":
+                user_id, partner_id = int(fields[1]), int(fields[2])
+                backend.queue.discard(user_id)
+                backend.queue.discard(partner_id)
+                backend.sessions[user_id] = partner_id
+                backend.sessions[partner_id] = user_id
+            elif op == "S":
+                for user_id in (int(fields[1]), int(fields[2])):
+                    backend.sessions.pop(user_id, None)
+            else:
+                return False
+        except (IndexError, KeyError, ValueError):
+            return False
+        return True
+
+    # --- запись снимков ---
+    def _open_journal(self, generation: int):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_path(generation), "a", encoding="utf-8")
+
+    def _serialize(self, backend) -> bytes:
+        pairs = array("q")
+        for user_id, partner_id in backend.sessions.items():
+            if user_id < partner_id:
+                pairs.append(user_id)
+                pairs.append(partner_id)
+        user_ids, enqueued, buckets = array("q"), array("d"), array("b")
+        bucket_index = {key: i for i, key in enumerate(BUCKETS)}
+        for user_id, key, enqueued_at in backend.queue.items():
+            user_ids.append(user_id)
+            enqueued.append(enqueued_at)
+            buckets.append(bucket_index[key])
+        header = self.HEADER.pack(self.MAGIC, self.generation, time.time(), len(pairs) // 2, len(user_ids))
+        return b"".join((header, pairs.tobytes(), user_ids.tobytes(), enqueued.tobytes(), buckets.tobytes()))
+
+    def _write(self, data: bytes):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _rotate(self, backend) -> bytes:
+        # Состояние и переключение журнала — синхронно, без await между ними:
+        # всё, что случится позже, попадёт уже в журнал нового поколения
+        self.generation += 1
+        data = self._serialize(backend)
+        self._open_journal(self.generation)
+        self.dirty = False
+        return data
+
+    def _remove_old_journals(self):
+        for generation in self._journals():
+            if generation < self.generation:
+                os.remove(self._journal_path(generation))
+
+    async def snapshot(self, backend):
+        await asyncio.to_thread(self._write, self._rotate(backend))
+        self._remove_old_journals()
+
+    def start(self, backend):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(backend))
+
+    async def _run(self, backend):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.dirty:
+                try:
+                    await self.snapshot(backend)
+                except OSError as e:
+                    logging.error(f"Snapshot error: {e}")
+
+    async def close(self, backend):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.snapshot(backend)
+        self._journal.close()
+        self._journal = None
+
+# === МЕЖПРОЦЕССНОЕ ВЗАИМОДЕЙСТВИЕ ===
+# Протокол между супервизором и воркерами — строки JSON через unix-сокеты в IPC_DIR.
+# Воркер → супервизор: запрос [id, метод, аргументы], ответ [id, результат, ошибка].
+# Супервизор → воркер: {"update": ...} или {"event": имя, "args": [...]}.
+IPC_LINE_LIMIT = 2 ** 22
+IPC_METHODS = {
+    "enqueue", "dequeue", "is_searching", "search_preference", "enqueued_at", "queue_size", "get_partner", "end_session",
+    "session_count", "is_rate_limited", "set_captcha", "get_captcha", "fail_captcha", "pass_captcha",
+}
+
+def control_socket_path(directory: str) -> str:
+    return os.path.join(directory, "supervisor.sock")
+
+def worker_socket_path(directory: str, index: int) -> str:
+    return os.path.join(directory, f"worker.{index}.sock")
+
+class IpcClient:
+    """Соединение воркера с супервизором: запросы идут по одному сокету, ответы сопоставляются по id."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._pending = {}
+        self._seq = itertools.count(1)
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def _connect(self):
+        async with self._lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=IPC_LINE_LIMIT)
+                self._task = asyncio.create_task(self._read())
+
+    async def call(self, method: str, *args):
+        if self._writer is None:
+            await self._connect()
+        request_id = next(self._seq)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        self._writer.write((json.dumps([request_id, method, args]) + "\n").encode())
+        return await future
+
+    async def emit(self, shard: int, event: str, args: list):
+        await self.call("emit", shard, event, args)
+
+    async def _read(self):
+        try:
+            while line := await self._reader.readline():
+                request_id, result, error = json.loads(line)
+                future = self._pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(error))
+        finally:
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("supervisor connection lost"))
+            self._pending.clear()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+class IpcStateBackend:
+    """Состояние воркера живёт у супервизора в MemoryStateBackend — здесь только вызовы к нему."""
+
+    def __init__(self, client: IpcClient):
+        self.client = client
+
+    def start(self):
+        pass
+
+    async def close(self):
+        await self.client.close()
+
+    async def enqueue(self, user_id: int, own_gender: str, pref: str, tier: int = TIER_NORMAL, now: float = None):
+        match = await self.client.call("enqueue", user_id, own_gender, pref, tier, now)
+        return tuple(match) if match else None
+
+    async def dequeue(self, user_id: int, enqueued_at: float = None) -> bool:
+        return await self.client.call("dequeue", user_id, enqueued_at)
+
+    async def is_searching(self, user_id: int) -> bool:
+        return await self.client.call("is_searching", user_id)
+
+    async def search_preference(self, user_id: int):
+        return await self.client.call("search_preference", user_id)
+
+    async def enqueued_at(self, user_id: int):
+        return await self.client.call("enqueued_at", user_id)
+
+    async def queue_size(self) -> int:
+        return await self.client.call("queue_size")
+
+    async def get_partner(self, user_id: int):
+        return await self.client.call("get_partner", user_id)
+
+    async def end_session(self, user_id: int):
+        return await self.client.call("end_session", user_id)
+
+    async def session_count(self) -> int:
+        return await self.client.call("session_count")
+
+    async def is_rate_limited(self, user_id: int) -> bool:
+        return await self.client.call("is_rate_limited", user_id)
+
+    async def set_captcha(self, user_id: int, correct: str, reset_attempts: bool):
+        await self.client.call("set_captcha", user_id, correct, reset_attempts)
+
+    async def get_captcha(self, user_id: int):
+        return await self.client.call("get_captcha", user_id)
+
+    async def fail_captcha(self, user_id: int) -> int:
+        return await self.client.call("fail_captcha", user_id)
+
+    async def pass_captcha(self, user_id: int):
+        await self.client.call("pass_captcha", user_id)
+
+ipc = IpcClient(control_socket_path(IPC_DIR)) if IS_WORKER else None
+
+if redis:
+    state_backend = RedisStateBackend(redis, REDIS_PREFIX, MATCH_POLICY)
+elif IS_WORKER:
+    state_backend = IpcStateBackend(ipc)
+else:
+    state_backend = MemoryStateBackend(
+        MATCH_POLICY, StateSnapshots(STATE_DIR, SNAPSHOT_INTERVAL) if STATE_DIR else None
+    )
+
+# === ПУЛ СОЕДИНЕНИЙ ===
+db_pool = None
+db_pool_stats = {
+    "in_use": 0,
+    "acquired": 0,
+    "acquire_failures": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0,
+}
+
+async def create_db_pool():
+    global db_pool
+    # Запросы ниже отправляются одним и тем же текстом, поэтому asyncpg
+    # готовит их один раз на соединение и дальше берёт из кэша выражений.
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    )
+
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+@asynccontextmanager
+async def db_connection(query: str = "other"):
+    started = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except Exception:
+        db_pool_stats["acquire_failures"] += 1
+        if METRICS_ENABLED:
+            DB_QUERY_ERRORS.labels(query).inc()
+        raise
+    waited = time.perf_counter() - started
+    db_pool_stats["acquired"] += 1
+    db_pool_stats["wait_total"] += waited
+    db_pool_stats["wait_max"] = max(db_pool_stats["wait_max"], waited)
+    db_pool_stats["in_use"] += 1
+    try:
+        yield conn
+    except Exception:
+        if METRICS_ENABLED:
+            DB_QUERY_ERRORS.labels(query).inc()
+        raise
+    finally:
+        db_pool_stats["in_use"] -= 1
+        await db_pool.release(conn)
+        if METRICS_ENABLED:
+            DB_QUERY_LATENCY.labels(query).observe(time.perf_counter() - started)
+
+def get_db_pool_stats() -> dict:
+    acquired = db_pool_stats["acquired"]
+    return {
+        **db_pool_stats,
+        "size": db_pool.get_size() if db_pool else 0,
+        "max_size": DB_POOL_MAX_SIZE,
+        "wait_avg": db_pool_stats["wait_total"] / acquired if acquired else 0.0,
+    }
+
+# === КЭШ ПОЛЬЗОВАТЕЛЕЙ ===
+_MISSING = object()
+
+class UserCache:
+    """LRU-кэш строк users с TTL; None кэшируется как «пользователя нет»."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, user_id: int):
+        item = self._items.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self._items.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def put(self, user_id: int, row):
+        self._items[user_id] = (time.monotonic() + self.ttl, row)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def update(self, user_id: int, **fields):
+        # Обновляем только живую строку; иначе просто сбрасываем запись и перечитаем её из БД
+        item = self._items.get(user_id)
+        if item is None or item[1] is None or item[0] < time.monotonic():
+            self.invalidate(user_id)
+            return
+        self.put(user_id, {**dict(item[1]), **fields})
+
+    def invalidate(self, user_id: int):
+        self._items.pop(user_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+class UserCacheSync:
+    """Сброс кэша users и баны между инстансами с общим Redis.
+
+    Каждая запись в users публикует id в канал, остальные инстансы выбрасывают строку из
+    своего кэша и перечитают её из БД. Бан и разбан публикуют id вместе со сроком — его
+    сразу кладут в BanList, не дожидаясь сверки. Свои сообщения узнаём по метке инстанса
+    и пропускаем."""
+
+    def __init__(self, client: Redis, channel: str):
+        self.redis = client
+        self.channel = channel
+        self.instance = f"{os.getpid()}.{random.getrandbits(32):x}"
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def publish(self, user_id: int):
+        try:
+            await self.redis.publish(self.channel, f"{self.instance}:{user_id}")
+        except Exception as e:
+            logging.error(f"User cache publish error: {e}")
+
+    async def publish_bans(self, user_ids: list, banned_until: float):
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    pipe.publish(self.channel, f"{self.instance}:{user_id}:{banned_until!r}")
+                await pipe.execute()
+        except Exception as e:
+            logging.error(f"Ban publish error: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    # Пока подписки не было, сбросы и баны могли пройти мимо — начинаем с пустого
+                    # кэша и перечитываем баны
+                    user_cache.clear()
+                    await bot_stats.reconcile()
+                    async for message in pubsub.listen():
+                        instance, user_id, *banned_until = message["data"].split(":")
+                        if instance == self.instance:
+                            continue
+                        if banned_until:
+                            await _ban_changed(int(user_id), float(banned_until[0]))
+                        else:
+                            user_cache.invalidate(int(user_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"User cache subscription error: {e}")
+                await asyncio.sleep(1)
+
+user_cache_sync = UserCacheSync(redis, f"{REDIS_PREFIX}:users") if redis else None
+
+class ReputationCache:
+    """LRU-кэш пар (👍, 👎) с TTL. Значения приходят из БД при промахе и после каждого сброса оценок."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._scores = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+    def put(self, user_id: int, good: int, bad: int):
+        self._scores[user_id] = (time.monotonic() + self.ttl, good, bad)
+        self._scores.move_to_end(user_id)
+        while len(self._scores) > self.max_size:
+            self._scores.popitem(last=False)
+
+    async def get(self, user_id: int) -> tuple:
+        item = self._scores.get(user_id)
+        if item is not None and item[0] >= time.monotonic():
+            self._scores.move_to_end(user_id)
+            return item[1], item[2]
+        async with db_connection("get_reputation") as conn:
+            row = await conn.fetchrow(SQL_GET_REPUTATION, user_id)
+        good, bad = (row["good"], row["bad"]) if row else (0, 0)
+        self.put(user_id, good, bad)
+        return good, bad
+
+    async def tier(self, user_id: int) -> int:
+        if REPUTATION_MODE == "off":
+            return TIER_NORMAL
+        return reputation_tier(*await self.get(user_id))
+
+reputation = ReputationCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# === БАНЫ ===
+class BanList:
+    """Активные баны в памяти: словарь user_id → срок и min-heap (срок, user_id) для истечения.
+
+    Проверка бана — поиск в словаре, без обращения к БД. Истёкшие баны снимаются с вершины кучи;
+    записи, перекрытые повторным баном или разбаном, остаются в куче и отбрасываются при снятии.
+    Пока список перечитывается из БД, set() дополнительно запоминаются и накладываются на
+    загруженное — иначе бан, пришедший во время запроса, пропал бы до следующей сверки."""
+
+    def __init__(self):
+        self._until = {}
+        self._heap = []
+        self._changes = None
+
+    def __len__(self) -> int:
+        self._expire(time.time())
+        return len(self._until)
+
+    def get(self, user_id: int) -> float:
+        until = self._until.get(user_id, 0)
+        if until and until <= time.time():
+            self._expire(time.time())
+            return 0
+        return until
+
+    def set(self, user_id: int, until: float):
+        if self._changes is not None:
+            self._changes[user_id] = until
+        if until > time.time():
+            self._until[user_id] = until
+            heapq.heappush(self._heap, (until, user_id))
+        else:
+            self._until.pop(user_id, None)
+        # Частые перебаны копят мёртвые записи — пересобираем кучу, когда их становится больше живых
+        if len(self._heap) > 2 * len(self._until) + 1024:
+            self._heap = [(until, user_id) for user_id, until in self._until.items()]
+            heapq.heapify(self._heap)
+
+    def track_changes(self):
+        self._changes = {}
+
+    def stop_tracking(self):
+        self._changes = None
+
+    def load(self, rows):
+        banned = {row["user_id"]: row["banned_until"] for row in rows}
+        now = time.time()
+        for user_id, until in (self._changes or {}).items():
+            if until > now:
+                banned[user_id] = until
+            else:
+                banned.pop(user_id, None)
+        self._changes = None
+        self._until = banned
+        self._heap = [(until, user_id) for user_id, until in self._until.items()]
+        heapq.heapify(self._heap)
+
+    def _expire(self, now: float):
+        while self._heap and self._heap[0][0] <= now:
+            until, user_id = heapq.heappop(self._heap)
+            if self._until.get(user_id) == until:
+                del self._until[user_id]
+
+bans = BanList()
+
+# === СТАТИСТИКА ===
+class RollingSeries:
+    """Поминутные суммы за последний час в кольцевом буфере."""
+
+    def __init__(self, minutes: int = 60):
+        self.minutes = minutes
+        self._stamps = array("q", [-1]) * minutes
+        self._counts = array("q", [0]) * minutes
+        self._totals = array("d", [0.0]) * minutes
+
+    def add(self, value: float = 1.0):
+        minute = int(time.time() // 60)
+        index = minute % self.minutes
+        if self._stamps[index] != minute:
+            self._stamps[index] = minute
+            self._counts[index] = 0
+            self._totals[index] = 0.0
+        self._counts[index] += 1
+        self._totals[index] += value
+
+    def window(self, minutes: int):
+        """(количество, сумма) за последние minutes минут, включая текущую."""
+        now = int(time.time() // 60)
+        count = 0
+        total = 0.0
+        for minute in range(now - min(minutes, self.minutes) + 1, now + 1):
+            index = minute % self.minutes
+            if self._stamps[index] == minute:
+                count += self._counts[index]
+                total += self._totals[index]
+        return count, total
+
+class BotStats:
+    """Счётчики для /stats: меняются на месте при регистрации и сверяются с БД по таймеру вместе со списком банов."""
+
+    def __init__(self, reconcile_interval: float):
+        self.reconcile_interval = reconcile_interval
+        self.total_users = 0
+        self.reconciled_at = 0.0
+        self.matches = RollingSeries()
+        self.relayed = RollingSeries()
+        self._reconciling = asyncio.Lock()
+        self._task = None
+
+    def user_created(self):
+        self.total_users += 1
+
+    def match(self, waited: float):
+        self.matches.add(waited)
+
+    def relay(self, count: int = 1):
+        self.relayed.add(count)
+
+    async def reconcile(self):
+        # Сверку зовут и таймер, и переподписка UserCacheSync — две сразу сбили бы друг другу track_changes
+        async with self._reconciling:
+            bans.track_changes()
+            try:
+                self.total_users, banned = await count_users_in_db()
+                bans.load(banned)
+                self.reconciled_at = time.time()
+            except Exception as e:
+                logging.error(f"Stats reconcile error: {e}")
+            finally:
+                bans.stop_tracking()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        # Правки в обход бота и, без общего Redis, баны с других инстансов память не видит — их догоняет сверка.
+        # Первую сверку делает on_startup, чтобы баны были в памяти до первого апдейта
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            await self.reconcile()
+
+bot_stats = BotStats(STATS_RECONCILE_INTERVAL)
+
+# === МИГРАЦИИ ===
+# Версия схемы — номер последней применённой миграции в MIGRATIONS (с единицы).
+# Выпущенные миграции не правим: изменения схемы только дописываются в конец списка.
+MIGRATIONS = [
+    # 1. Исходная схема. IF NOT EXISTS — базы, созданные до появления миграций, проходят её как есть
+    [
+        """
         CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
             own_gender TEXT CHECK (own_gender IN ('male', 'female')),
             search_preference TEXT CHECK (search_preference IN ('male', 'female', 'any')),
             banned_until DOUBLE PRECISION DEFAULT 0
-        );
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS ratings (
             rater_id BIGINT,
             rated_id BIGINT,
             rating BOOLEAN,
             created_at TIMESTAMP DEFAULT NOW(),
             PRIMARY KEY (rater_id, rated_id)
-        );
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS reports (
             reporter_id BIGINT,
             reported_id BIGINT,
             message_text TEXT,
             media_file_id TEXT,
             reported_at TIMESTAMP DEFAULT NOW()
-        );
-    """)
-    await conn.close()
+        )
+        """,
+    ],
+    # 2. Ключ для reports и индексы под запросы бота
+    [
+        "ALTER TABLE reports ADD COLUMN IF NOT EXISTS id BIGSERIAL PRIMARY KEY",
+        "CREATE INDEX IF NOT EXISTS ratings_rated_id_idx ON ratings (rated_id)",
+        "CREATE INDEX IF NOT EXISTS users_banned_until_idx ON users (banned_until) WHERE banned_until > 0",
+        "CREATE INDEX IF NOT EXISTS reports_reported_idx ON reports (reported_id, reported_at)",
+    ],
+    # 3. Репутация: накопленные 👍/👎 по каждому оценённому пользователю
+    [
+        """
+        CREATE TABLE user_reputation (
+            user_id BIGINT PRIMARY KEY,
+            good INTEGER NOT NULL DEFAULT 0,
+            bad INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO user_reputation (user_id, good, bad)
+        SELECT rated_id, COUNT(*) FILTER (WHERE rating), COUNT(*) FILTER (WHERE NOT rating)
+        FROM ratings
+        GROUP BY rated_id
+        """,
+    ],
+]
+MIGRATIONS_LOCK_ID = 0x616E6F6E63686174  # произвольный ключ advisory lock, общий для всех экземпляров бота
+SQL_SCHEMA_VERSION = "SELECT version FROM schema_version"
+
+async def init_db():
+    # Обычный старт — один запрос: схема уже актуальна
+    async with db_connection("init_db") as conn:
+        try:
+            version = await conn.fetchval(SQL_SCHEMA_VERSION)
+        except asyncpg.UndefinedTableError:
+            version = None
+        if version != len(MIGRATIONS):
+            await migrate(conn)
+
+async def migrate(conn):
+    # Несколько экземпляров могут стартовать одновременно: мигрирует один, остальные ждут на блокировке
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+    try:
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        version = await conn.fetchval(SQL_SCHEMA_VERSION)
+        if version is None:
+            await conn.execute("INSERT INTO schema_version (version) VALUES (0)")
+            version = 0
+        if version > len(MIGRATIONS):
+            logging.warning(f"Schema version {version} is newer than this bot ({len(MIGRATIONS)})")
+            return
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            async with conn.transaction():
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute("UPDATE schema_version SET version = $1", number)
+            print(f"✅ Миграция {number} применена")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+# === ФУНКЦИИ РАБОТЫ С БД ===
+SQL_GET_USER = "SELECT * FROM users WHERE user_id = $1"
+# xmax = 0 только у только что вставленной строки — так отличаем нового пользователя от обновления
+SQL_SAVE_USER = """
+    INSERT INTO users (user_id, own_gender, search_preference, banned_until)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id) DO UPDATE
+    SET own_gender = $2, search_preference = $3, banned_until = $4
+    RETURNING (xmax = 0) AS inserted
+"""
+# Бан и разбан пачкой — один запрос на весь список; id в массиве должны быть уникальны,
+# иначе ON CONFLICT дважды заденет одну строку
+SQL_BAN_USERS = """
+    INSERT INTO users (user_id, banned_until)
+    SELECT unnest($1::bigint[]), $2
+    ON CONFLICT (user_id) DO UPDATE
+    SET banned_until = $2
+    RETURNING (xmax = 0) AS inserted
+"""
+# Разбан обнуляет срок, чтобы строка выпала из частичного индекса users_banned_until_idx
+SQL_UNBAN_USERS = "UPDATE users SET banned_until = 0 WHERE user_id = ANY($1::bigint[]) AND banned_until > 0 RETURNING user_id"
+# Пачка оценок одним запросом: повторные оценки той же пары отбрасываются, а счётчики
+# репутации растут только на реально вставленные строки и сразу возвращаются в кэш
+SQL_SAVE_RATINGS = """
+    WITH inserted AS (
+        INSERT INTO ratings (rater_id, rated_id, rating)
+        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::boolean[])
+        ON CONFLICT (rater_id, rated_id) DO NOTHING
+        RETURNING rated_id, rating
+    )
+    INSERT INTO user_reputation AS r (user_id, good, bad)
+    SELECT rated_id, COUNT(*) FILTER (WHERE rating), COUNT(*) FILTER (WHERE NOT rating)
+    FROM inserted
+    GROUP BY rated_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET good = r.good + EXCLUDED.good, bad = r.bad + EXCLUDED.bad
+    RETURNING user_id, good, bad
+"""
+SQL_GET_REPUTATION = "SELECT good, bad FROM user_reputation WHERE user_id = $1"
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+# Условие совпадает с частичным индексом users_banned_until_idx (миграция 2)
+SQL_ACTIVE_BANS = "SELECT user_id, banned_until FROM users WHERE banned_until > 0 AND banned_until > $1"
+
+# === ОТЛОЖЕННАЯ ЗАПИСЬ ===
+MAX_BIGINT = 2**63 - 1
+# Ошибки, которые вызывает содержимое строки, а не БД: повтор той же пачки их не исправит
+ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError, OverflowError, ValueError, TypeError)
+
+class WriteBehindBuffer:
+    """Копит строки в памяти и пишет их в БД пачками — по размеру или по таймеру.
+
+    Если пачку отверг сам её состав, она дописывается по одной строке и теряются только
+    плохие строки. При прочих ошибках пачка возвращается в начало и ждёт следующего тика."""
+
+    def __init__(self, name: str, write, max_batch: int, interval: float):
+        self.name = name
+        self.write = write
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_batch * 20
+        self.flushed = 0
+        self.dropped = 0
+        self._rows = []
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._flushes = set()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, row: tuple):
+        self._rows.append(row)
+        if len(self._rows) == self.max_batch:
+            task = asyncio.create_task(self.flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        async with self._lock:
+            while self._rows:
+                rows = self._rows[:self.max_batch]
+                del self._rows[:self.max_batch]
+                try:
+                    async with db_connection(f"flush_{self.name}") as conn:
+                        try:
+                            await self.write(conn, rows)
+                        except ROW_ERRORS as e:
+                            logging.error(f"Flush {self.name} rejected a batch, writing row by row: {e}")
+                            await self._write_rows(conn, rows)
+                            continue
+                except Exception as e:
+                    logging.error(f"Flush {self.name} error: {e}")
+                    self._requeue(rows)
+                    return
+                self.flushed += len(rows)
+
+    async def _write_rows(self, conn, rows: list):
+        """Пишет строки по одной и отбрасывает те, что БД не принимает.
+
+        Записанные строки убираются из rows, так что при обрыве соединения в нём остаётся
+        ровно то, что нужно вернуть в очередь."""
+        while rows:
+            try:
+                await self.write(conn, rows[:1])
+                self.flushed += 1
+            except ROW_ERRORS as e:
+                logging.error(f"Flush {self.name} dropped row {rows[0]!r}: {e}")
+                self.dropped += 1
+            del rows[0]
+
+    def _requeue(self, rows: list):
+        # Возвращаем пачку в начало и попробуем на следующем тике, но без бесконечного роста
+        self._rows[:0] = rows
+        overflow = len(self._rows) - self.max_pending
+        if overflow > 0:
+            del self._rows[:overflow]
+            self.dropped += overflow
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._flushes, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+async def _write_ratings(conn, rows: list):
+    rater_ids, rated_ids, ratings = zip(*rows)
+    for row in await conn.fetch(SQL_SAVE_RATINGS, rater_ids, rated_ids, ratings):
+        reputation.put(row["user_id"], row["good"], row["bad"])
+
+async def _write_reports(conn, rows: list):
+    await conn.copy_records_to_table(
+        "reports",
+        records=rows,
+        columns=["reporter_id", "reported_id", "message_text", "media_file_id"],
+    )
+
+rating_writer = WriteBehindBuffer("ratings", _write_ratings, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)
+report_writer = WriteBehindBuffer("reports", _write_reports, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)
 
 async def get_user_from_db(user_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
-    row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-    await conn.close()
+    row = user_cache.get(user_id)
+    if row is not _MISSING:
+        return row
+    async with db_connection("get_user") as conn:
+        row = await conn.fetchrow(SQL_GET_USER, user_id)
+    # С общим Redis регистрация может закончиться на другом инстансе — отсутствие строки не кэшируем
+    if row is not None or user_cache_sync is None:
+        user_cache.put(user_id, row)
     return row
 
 async def save_user_to_db(user_id: int, own_gender: str, search_preference: str, banned_until: float = 0):
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute("""
-        INSERT INTO users (user_id, own_gender, search_preference, banned_until)
-        VALUES ($1, $2, $3, $4)
-        ON CONFLICT (user_id) DO UPDATE
-        SET own_gender = $2, search_preference = $3, banned_until = $4
-    """, user_id, own_gender, search_preference, banned_until)
-    await conn.close()
-
-async def get_ban_from_db(user_id: int):
-    user = await get_user_from_db(user_id)
-    return user["banned_until"] if user else 0
-
-async def ban_user_in_db(user_id: int, hours: int = 4):
+    async with db_connection("save_user") as conn:
+        inserted = await conn.fetchval(SQL_SAVE_USER, user_id, own_gender, search_preference, banned_until)
+    if inserted:
+        bot_stats.user_created()
+    user_cache.put(user_id, {
+        "user_id": user_id,
+        "own_gender": own_gender,
+        "search_preference": search_preference,
+        "banned_until": banned_until,
+    })
+    if user_cache_sync is not None:
+        await user_cache_sync.publish(user_id)
+
+async def ban_users_in_db(user_ids: list, hours: int = 4):
     expires = time.time() + hours * 3600
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute("""
-        INSERT INTO users (user_id, banned_until)
-        VALUES ($1, $2)
-        ON CONFLICT (user_id) DO UPDATE
-        SET banned_until = $2
-    """, user_id, expires)
-    await conn.close()
+    async with db_connection("ban_users") as conn:
+        rows = await conn.fetch(SQL_BAN_USERS, user_ids, expires)
+    for row in rows:
+        if row["inserted"]:
+            bot_stats.user_created()
+    for user_id in user_ids:
+        await on_user_shard(user_id, "ban_changed", user_id, expires)
+    if user_cache_sync is not None:
+        await user_cache_sync.publish_bans(user_ids, expires)
+
+async def unban_users_in_db(user_ids: list) -> int:
+    async with db_connection("unban_users") as conn:
+        rows = await conn.fetch(SQL_UNBAN_USERS, user_ids)
+    for user_id in user_ids:
+        await on_user_shard(user_id, "ban_changed", user_id, 0)
+    if user_cache_sync is not None:
+        await user_cache_sync.publish_bans(user_ids, 0)
+    return len(rows)
+
+async def _ban_changed(user_id: int, banned_until: float):
+    bans.set(user_id, banned_until)
+    user_cache.update(user_id, banned_until=banned_until)
 
 async def save_rating(rater_id: int, rated_id: int, rating: bool):
-    conn = await asyncpg.connect(DATABASE_URL)
-    await conn.execute("""
-        INSERT INTO ratings (rater_id, rated_id, rating)
-        VALUES ($1, $2, $3)
-        ON CONFLICT (rater_id, rated_id) DO NOTHING
-    """, rater_id, rated_id, rating)
-    await conn.close()
+    rating_writer.add((rater_id, rated_id, rating))
+
+async def save_report(reporter_id, reported_id: int, message_text, media_file_id):
+    report_writer.add((reporter_id, reported_id, message_text, media_file_id))
+
+async def count_users_in_db():
+    async with db_connection("count_users") as conn:
+        total_users = await conn.fetchval(SQL_COUNT_USERS)
+        banned = await conn.fetch(SQL_ACTIVE_BANS, time.time())
+    return total_users, banned
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 def is_banned(banned_until: float) -> bool:
@@ -176,20 +2370,10 @@ def get_ban_time_left(banned_until: float) -> str:
     minutes = (seconds % 3600) // 60
     return f"{hours}ч {minutes}мин"
 
-def is_rate_limited(user_id: int) -> bool:
-    now = time.time()
-    user_command_count[user_id] = [t for t in user_command_count[user_id] if now - t < 60]
-    if len(user_command_count[user_id]) >= 30:
-        return True
-    user_command_count[user_id].append(now)
-    return False
-
-def trigger_captcha(user_id: int):
-    user_captcha_attempts[user_id] = 0
-    emojis = ["🍎", "🚗", "😊", "🐱", "🌈", "🍕", "🚀", "⚽", "🎮", "📚"]
-    correct = random.choice(emojis)
-    captcha_challenges[user_id] = correct
-    options = random.sample([e for e in emojis if e != correct], 5) + [correct]
+async def trigger_captcha(user_id: int, reset_attempts: bool = True):
+    correct = random.choice(CAPTCHA_EMOJIS)
+    await state_backend.set_captcha(user_id, correct, reset_attempts)
+    options = random.sample([e for e in CAPTCHA_EMOJIS if e != correct], 5) + [correct]
     random.shuffle(options)
     return correct, options
 
@@ -197,9 +2381,9 @@ def trigger_captcha(user_id: int):
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    banned_until = await get_ban_from_db(user_id)
+    banned_until = bans.get(user_id)
     if is_banned(banned_until):
-        await message.answer(f"⚠️ Вы забанены. Осталось: {get_ban_time_left(banned_until)}")
+        await message.answer(BANNED_TEXT.format(get_ban_time_left(banned_until)))
         return
     await state.clear()
     user_data = await get_user_from_db(user_id)
@@ -209,11 +2393,11 @@ async def cmd_start(message: types.Message, state: FSMContext):
             "1️⃣ Сначала выберите **ваш пол**\n"
             "2️⃣ Затем — **кого искать**: парня, девушку или любого собеседника\n\n"
             "Начнём?",
-            reply_markup=get_own_gender_kb()
+            reply_markup=OWN_GENDER_KB
         )
         await state.set_state(UserState.choosing_own_gender)
     else:
-        await message.answer("Выберите действие:", reply_markup=get_idle_kb())
+        await message.answer(CHOOSE_ACTION_TEXT, reply_markup=IDLE_KB)
 
 @dp.message(UserState.choosing_own_gender)
 async def choose_own_gender(message: types.Message, state: FSMContext):
@@ -223,7 +2407,7 @@ async def choose_own_gender(message: types.Message, state: FSMContext):
     own_gender = "male" if message.text == "Мужчина" else "female"
     await state.update_data(temp_user={"own_gender": own_gender})
     await state.set_state(UserState.choosing_search_pref)
-    await message.answer("Кого вы хотите найти?", reply_markup=get_search_pref_kb())
+    await message.answer("Кого вы хотите найти?", reply_markup=SEARCH_PREF_KB)
 
 @dp.message(UserState.choosing_search_pref)
 async def choose_search_pref(message: types.Message, state: FSMContext):
@@ -239,44 +2423,55 @@ async def choose_search_pref(message: types.Message, state: FSMContext):
         await message.answer("Пожалуйста, выберите из кнопок.")
         return
     data = await state.get_data()
-    own_gender = data["temp_user"]["own_gender"]
+    if "temp_user" in data:
+        own_gender = data["temp_user"]["own_gender"]
+    else:
+        user_data = await get_user_from_db(user_id)
+        own_gender = user_data["own_gender"]
     await save_user_to_db(user_id, own_gender, pref)
     await state.clear()
-    target = {"male": "парня", "female": "девушку", "any": "собеседника"}[pref]
-    await message.answer(f"✅ Готово! Ищите {target} через /search", reply_markup=get_idle_kb())
+    target = SEARCH_TARGETS[pref]
+    searching_since = await state_backend.enqueued_at(user_id)
+    if searching_since is not None and await state_backend.dequeue(user_id, searching_since):
+        # Поиск продолжается с новыми настройками, а таймеры досчитывают прежнее ожидание
+        await state.set_state(UserState.in_search)
+        await message.answer(f"✅ Готово! Продолжаем искать {target}...", reply_markup=SEARCH_KB)
+        await enqueue_for_match(user_id, own_gender, pref, time.time() - searching_since)
+        return
+    await message.answer(f"✅ Готово! Ищите {target} через /search", reply_markup=IDLE_KB)
 
 @dp.message(Command("gender"))
 async def cmd_gender(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    banned_until = await get_ban_from_db(user_id)
+    banned_until = bans.get(user_id)
     if is_banned(banned_until):
-        await message.answer(f"⚠️ Вы забанены. Осталось: {get_ban_time_left(banned_until)}")
+        await message.answer(BANNED_TEXT.format(get_ban_time_left(banned_until)))
         return
-    if is_rate_limited(user_id):
-        correct, options = trigger_captcha(user_id)
+    if await state_backend.is_rate_limited(user_id):
+        correct, options = await trigger_captcha(user_id)
         opts_text = " ".join(options)
         await message.answer(
-            f"Выберите смайлик: ({correct})\nВарианты: {opts_text}",
-            reply_markup=types.ReplyKeyboardRemove()
+            CAPTCHA_TEXT.format(correct, opts_text),
+            reply_markup=REMOVE_KB
         )
         await state.set_state(UserState.waiting_for_captcha)
         return
     await state.set_state(UserState.choosing_search_pref)
-    await message.answer("Измените предпочтения поиска:", reply_markup=get_search_pref_kb())
+    await message.answer("Измените предпочтения поиска:", reply_markup=SEARCH_PREF_KB)
 
 @dp.message(Command("search"))
 async def cmd_search(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    banned_until = await get_ban_from_db(user_id)
+    banned_until = bans.get(user_id)
     if is_banned(banned_until):
-        await message.answer(f"⚠️ Вы забанены. Осталось: {get_ban_time_left(banned_until)}")
+        await message.answer(BANNED_TEXT.format(get_ban_time_left(banned_until)))
         return
-    if is_rate_limited(user_id):
-        correct, options = trigger_captcha(user_id)
+    if await state_backend.is_rate_limited(user_id):
+        correct, options = await trigger_captcha(user_id)
         opts_text = " ".join(options)
         await message.answer(
-            f"Выберите смайлик: ({correct})\nВарианты: {opts_text}",
-            reply_markup=types.ReplyKeyboardRemove()
+            CAPTCHA_TEXT.format(correct, opts_text),
+            reply_markup=REMOVE_KB
         )
         await state.set_state(UserState.waiting_for_captcha)
         return
@@ -285,115 +2480,122 @@ async def cmd_search(message: types.Message, state: FSMContext):
     if not user_data:
         await message.answer("Сначала укажите ваш пол через /start")
         return
-    if user_id in active_sessions:
-        await message.answer("Вы уже в чате!", reply_markup=get_chat_kb())
+    if await state_backend.get_partner(user_id) is not None:
+        await message.answer("Вы уже в чате!", reply_markup=CHAT_KB)
         return
-    if user_id in search_queue:
-        await message.answer("Вы уже в поиске...", reply_markup=get_search_kb())
+    if await state_backend.is_searching(user_id):
+        await message.answer("Вы уже в поиске...", reply_markup=SEARCH_KB)
         return
 
-    search_queue.add(user_id)
     await state.set_state(UserState.in_search)
     pref = user_data["search_preference"]
-    target = {"male": "парня", "female": "девушку", "any": "собеседника"}[pref]
-    await message.answer(f"Начат поиск 🙏, ищем 🔎 {target}...", reply_markup=get_search_kb())
+    target = SEARCH_TARGETS[pref]
+    await message.answer(f"Начат поиск 🙏, ищем 🔎 {target}...", reply_markup=SEARCH_KB)
+    await enqueue_for_match(user_id, user_data["own_gender"], pref)
 
-    start_time = time.time()
-    warned = False
+async def enqueue_for_match(user_id: int, own_gender: str, pref: str, waited: float = 0.0) -> bool:
+    """Ставит в поиск и заводит таймеры; True — пара нашлась сразу."""
+    tier = await reputation.tier(user_id)
+    enqueued_at = time.time()
+    match = await state_backend.enqueue(user_id, own_gender, pref, tier, enqueued_at)
+    if match is None:
+        schedule_search_timers(user_id, enqueued_at, waited)
+        return False
+    partner_id, waited = match
+    bot_stats.match(waited)
+    if METRICS_ENABLED:
+        TIME_TO_MATCH.observe(waited)
+        TIME_TO_MATCH.observe(0)
+    await notify_session_started(user_id, partner_id)
+    return True
 
-    async def _search_task():
-        nonlocal warned
-        try:
-            while time.time() - start_time < 300:
-                await asyncio.sleep(0.5)
-                if user_id not in search_queue:
-                    return
-                user_data = await get_user_from_db(user_id)
-                if not user_data:
-                    search_queue.discard(user_id)
-                    return
-                pref = user_data["search_preference"]
-                for candidate in list(search_queue):
-                    if candidate == user_id or candidate in active_sessions:
-                        continue
-                    candidate_data = await get_user_from_db(candidate)
-                    if not candidate_data:
-                        continue
-                    if pref == "any" or candidate_data["own_gender"] == pref:
-                        search_queue.discard(user_id)
-                        search_queue.discard(candidate)
-                        active_sessions[user_id] = candidate
-                        active_sessions[candidate] = user_id
-                        await state.set_state(UserState.in_chat)
-                        await bot.send_message(
-                            user_id,
-                            "✅ Собеседник найден, хорошего общения🫶🏻\n/next - следующий собеседник\n/stop - остановить диалог",
-                            reply_markup=get_chat_kb()
-                        )
-                        await bot.send_message(
-                            candidate,
-                            "✅ Собеседник найден, хорошего общения🫶🏻\n/next - следующий собеседник\n/stop - остановить диалог",
-                            reply_markup=get_chat_kb()
-                        )
-                        return
-                if not warned and time.time() - start_time > 120 and pref in ("male", "female"):
-                    warned = True
-                    await bot.send_message(
-                        user_id,
-                        "⚠️ Долго не удаётся найти собеседника нужного пола.\n"
-                        "Хотите переключиться на поиск любого собеседника (микс)?\n"
-                        "Используйте /gender, чтобы изменить настройки.",
-                        reply_markup=get_idle_kb()
-                    )
-            if user_id in search_queue:
-                search_queue.discard(user_id)
-                await bot.send_message(user_id, "❌ Не удалось найти собеседника. Попробуйте позже.", reply_markup=get_idle_kb())
-        except asyncio.CancelledError:
-            pass
+def schedule_search_timers(user_id: int, enqueued_at: float, waited: float = 0.0):
+    # Таймеры привязаны к времени постановки: при нескольких инстансах старый таймер
+    # другого процесса не тронет новый поиск того же пользователя
+    if waited < SEARCH_WARN_AFTER:
+        timers.schedule(("search_warn", user_id), SEARCH_WARN_AFTER - waited, _search_warn, user_id, enqueued_at)
+    timers.schedule(("search_expire", user_id), SEARCH_TIMEOUT - waited, _search_expire, user_id, enqueued_at)
+
+def cancel_search_timers(user_id: int):
+    timers.cancel(("search_warn", user_id))
+    timers.cancel(("search_expire", user_id))
 
-    asyncio.create_task(_search_task())
+async def notify_session_started(user_id: int, partner_id: int):
+    # Таймеры и FSM собеседника живут в воркере его шарда — туда и отправляем событие
+    for uid in (user_id, partner_id):
+        await on_user_shard(uid, "session_started", uid)
+
+async def _session_started(user_id: int):
+    cancel_search_timers(user_id)
+    await dp.fsm.get_context(bot, chat_id=user_id, user_id=user_id).set_state(UserState.in_chat)
+    outbox.submit(user_id, partial(
+        bot.send_message,
+        user_id,
+        MATCH_TEXT,
+        reply_markup=CHAT_KB
+    ))
+
+async def _resume_search(user_id: int, enqueued_at: float):
+    waited = time.time() - enqueued_at
+    if waited >= SEARCH_TIMEOUT:
+        await _search_expire(user_id, enqueued_at)
+        return
+    schedule_search_timers(user_id, enqueued_at, waited)
+
+async def _search_warn(user_id: int, enqueued_at: float):
+    if await state_backend.enqueued_at(user_id) != enqueued_at:
+        return
+    if await state_backend.search_preference(user_id) in ("male", "female"):
+        outbox.submit(user_id, partial(
+            bot.send_message,
+            user_id,
+            "⚠️ Долго не удаётся найти собеседника нужного пола.\n"
+            "Хотите переключиться на поиск любого собеседника (микс)?\n"
+            "Используйте /gender, чтобы изменить настройки.",
+            reply_markup=IDLE_KB
+        ))
+
+async def _search_expire(user_id: int, enqueued_at: float):
+    if await state_backend.dequeue(user_id, enqueued_at):
+        outbox.submit(user_id, partial(
+            bot.send_message, user_id, "❌ Не удалось найти собеседника. Попробуйте позже.", reply_markup=IDLE_KB
+        ))
 
 @dp.message(UserState.waiting_for_captcha)
 async def handle_captcha(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    correct = captcha_challenges.get(user_id)
-    if correct and message.text.strip() == correct:
-        del captcha_challenges[user_id]
-        user_captcha_attempts[user_id] = 0
-        user_command_count[user_id] = []
+    correct = await state_backend.get_captcha(user_id)
+    if correct and message.text and message.text.strip() == correct:
+        await state_backend.pass_captcha(user_id)
         await state.clear()
-        await message.answer("✅ Проверка пройдена!", reply_markup=get_idle_kb())
+        await message.answer("✅ Проверка пройдена!", reply_markup=IDLE_KB)
     else:
-        user_captcha_attempts[user_id] += 1
-        if user_captcha_attempts[user_id] >= 3:
-            await ban_user_in_db(user_id, 4)
-            banned_until = await get_ban_from_db(user_id)
+        attempts = await state_backend.fail_captcha(user_id)
+        if attempts >= 3:
+            await ban_users_in_db([user_id], 4)
+            banned_until = bans.get(user_id)
             await message.answer(f"⚠️ Доступ заблокирован на 4 часа. Осталось: {get_ban_time_left(banned_until)}")
             await state.clear()
         else:
-            correct, options = trigger_captcha(user_id)
+            correct, options = await trigger_captcha(user_id, reset_attempts=False)
             opts_text = " ".join(options)
-            await message.answer(
-                f"Неверно! Попытка {user_captcha_attempts[user_id]}/3\n"
-                f"Выберите смайлик: ({correct})\n"
-                f"Варианты: {opts_text}"
-            )
+            await message.answer(CAPTCHA_RETRY_TEXT.format(attempts, correct, opts_text))
 
 @dp.message(Command("stop"))
 async def cmd_stop(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    partner_id = active_sessions.get(user_id)
+    partner_id = await state_backend.end_session(user_id)
     if partner_id:
-        active_sessions.pop(user_id, None)
-        active_sessions.pop(partner_id, None)
-        await bot.send_message(partner_id, "Ваш собеседник покинул чат 😔", reply_markup=get_idle_kb())
+        outbox.submit(partner_id, partial(
+            bot.send_message, partner_id, PARTNER_LEFT_TEXT, reply_markup=IDLE_KB
+        ))
         # Показываем оценку ТОЛЬКО ушедшему
         await message.answer("Оцените собеседника:", reply_markup=get_rating_kb(partner_id))
         await state.set_state(UserState.rating_partner)
     else:
-        await message.answer("Вы не в чате.", reply_markup=get_idle_kb())
-    if user_id in search_queue:
-        search_queue.discard(user_id)
+        await message.answer("Вы не в чате.", reply_markup=IDLE_KB)
+    if await state_backend.dequeue(user_id):
+        cancel_search_timers(user_id)
     await state.clear()
 
 @dp.message(Command("next"))
@@ -408,6 +2610,9 @@ async def handle_rating(callback: types.CallbackQuery, state: FSMContext):
     try:
         _, partner_id_str, rating_str = callback.data.split("_")
         partner_id = int(partner_id_str)
+        # callback_data присылает клиент: чужой id вне BIGINT испортил бы всю пачку оценок
+        if not 0 < partner_id <= MAX_BIGINT or rating_str not in ("0", "1"):
+            raise ValueError(f"bad rating callback {callback.data!r}")
         rating = rating_str == "1"
         await save_rating(user_id, partner_id, rating)
         await callback.message.edit_text("Спасибо за оценку! ❤️")
@@ -420,23 +2625,26 @@ async def handle_rating(callback: types.CallbackQuery, state: FSMContext):
 @dp.message(Command("link"))
 async def cmd_link(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id not in active_sessions:
+    if await state_backend.get_partner(user_id) is None:
         await message.answer("Вы не в чате.")
         return
     await state.set_state(UserState.confirming_link)
-    await message.answer("Вы уверены, что хотите отправить ссылку на ваш профиль?", reply_markup=get_link_confirm_kb())
+    await message.answer("Вы уверены, что хотите отправить ссылку на ваш профиль?", reply_markup=LINK_CONFIRM_KB)
 
 @dp.callback_query(lambda c: c.data.startswith("link_confirm_"))
 async def handle_link_confirm(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     if callback.data == "link_confirm_yes":
-        if callback.from_user.username:
-            partner_id = active_sessions[user_id]
-            await bot.send_message(
+        partner_id = await state_backend.get_partner(user_id)
+        if partner_id is None:
+            await callback.message.edit_text("Вы не в чате.")
+        elif callback.from_user.username:
+            outbox.submit(partner_id, partial(
+                bot.send_message,
                 partner_id,
                 f"👤 Собеседник поделился профилем: [@{callback.from_user.username}](https://t.me/{callback.from_user.username})",
                 parse_mode="Markdown"
-            )
+            ), PRIORITY_RELAY)
             await callback.message.edit_text("✅ Ссылка отправлена!")
         else:
             await callback.message.edit_text("У вас нет username в Telegram.")
@@ -446,93 +2654,762 @@ async def handle_link_confirm(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 # === АДМИНКА ===
+BAN_FILE_MAX_SIZE = 1024 * 1024
+REJECTED_SHOWN = 20
+
+def parse_user_ids(text: str) -> tuple:
+    """(id, отвергнутые токены). Токены разделяются пробелами, переводами строк и запятыми;
+    id — только токен целиком из цифр, чтобы даты и прочие числа в файле не стали банами."""
+    user_ids, rejected = [], []
+    for token in text.replace(",", " ").split():
+        if token.isascii() and token.isdigit() and 0 < int(token) < 2**63:
+            user_ids.append(int(token))
+        else:
+            rejected.append(token)
+    return user_ids, rejected
+
+async def read_user_ids(message: types.Message, args: list) -> tuple:
+    """id из аргументов команды и из приложенного файла без повторов, плюс отвергнутые токены."""
+    user_ids, rejected = parse_user_ids(" ".join(args))
+    if message.document:
+        # Файл со списком id — команда тогда в подписи: /ban <часы> или /unban
+        if (message.document.file_size or 0) > BAN_FILE_MAX_SIZE:
+            raise ValueError
+        data = await bot.download(message.document)
+        file_ids, file_rejected = parse_user_ids(data.read().decode("utf-8-sig"))
+        user_ids += file_ids
+        rejected += file_rejected
+    return list(dict.fromkeys(user_ids)), rejected
+
+def rejected_text(rejected: list) -> str:
+    shown = ", ".join(rejected[:REJECTED_SHOWN])
+    more = f" и ещё {len(rejected) - REJECTED_SHOWN}" if len(rejected) > REJECTED_SHOWN else ""
+    return f"❌ Не похоже на user_id, ничего не сделано: {shown}{more}"
+
+# Command смотрит и в подпись, поэтому /ban и /unban срабатывают и на файл с подписью-командой
 @dp.message(Command("ban"))
 async def cmd_ban(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
-        parts = message.text.split()
-        if len(parts) != 3:
+        parts = (message.text or message.caption).split()[1:]
+        hours = int(parts[-1])
+        user_ids, rejected = await read_user_ids(message, parts[:-1])
+        if not (user_ids or rejected) or hours <= 0:
             raise ValueError
-        user_id = int(parts[1])
-        hours = int(parts[2])
-        await ban_user_in_db(user_id, hours)
-        await message.answer(f"✅ Пользователь {user_id} забанен на {hours}ч")
     except:
-        await message.answer("❌ Используй: /ban <user_id> <часы>")
+        await message.answer("❌ Используй: /ban <user_id> [user_id ...] <часы> или файл с id и подписью /ban <часы>")
+        return
+    if rejected:
+        await message.answer(rejected_text(rejected))
+        return
+    await ban_users_in_db(user_ids, hours)
+    if len(user_ids) == 1:
+        await message.answer(f"✅ Пользователь {user_ids[0]} забанен на {hours}ч")
+    else:
+        await message.answer(f"✅ Забанено пользователей: {len(user_ids)} на {hours}ч")
 
 @dp.message(Command("unban"))
 async def cmd_unban(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     try:
-        user_id = int(message.text.split()[1])
-        await ban_user_in_db(user_id, 0)
-        await message.answer(f"✅ Бан снят с {user_id}")
+        user_ids, rejected = await read_user_ids(message, (message.text or message.caption).split()[1:])
+        if not (user_ids or rejected):
+            raise ValueError
     except:
-        await message.answer("❌ Используй: /unban <user_id>")
+        await message.answer("❌ Используй: /unban <user_id> [user_id ...] или файл с id и подписью /unban")
+        return
+    if rejected:
+        await message.answer(rejected_text(rejected))
+        return
+    unbanned = await unban_users_in_db(user_ids)
+    if len(user_ids) == 1:
+        await message.answer(f"✅ Бан снят с {user_ids[0]}")
+    else:
+        await message.answer(f"✅ Бан снят с {unbanned} из {len(user_ids)} пользователей")
 
 @dp.message(Command("stats"))
 async def cmd_stats(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         return
-    total_users = 0
-    banned = 0
-    try:
-        conn = await asyncpg.connect(DATABASE_URL)
-        total_users = await conn.fetchval("SELECT COUNT(*) FROM users")
-        banned = await conn.fetchval("SELECT COUNT(*) FROM users WHERE banned_until > $1", time.time())
-        await conn.close()
-    except Exception as e:
-        logging.error(f"Stats error: {e}")
+    pool = get_db_pool_stats()
+    in_search = await state_backend.queue_size()
+    in_chat = await state_backend.session_count()
+    matches_5, waited_5 = bot_stats.matches.window(5)
+    matches_60, waited_60 = bot_stats.matches.window(60)
+    relayed_5, _ = bot_stats.relayed.window(5)
+    relayed_60, _ = bot_stats.relayed.window(60)
+    reconciled = int(time.time() - bot_stats.reconciled_at) if bot_stats.reconciled_at else None
     await message.answer(
         f"📊 Статистика:\n"
-        f"Всего пользователей: {total_users}\n"
-        f"Забанено: {banned}\n"
-        f"В поиске: {len(search_queue)}\n"
-        f"В чате: {len(active_sessions) // 2}"
+        f"Всего пользователей: {bot_stats.total_users}\n"
+        f"Забанено: {len(bans)}\n"
+        f"Сверка с БД: {f'{reconciled}с назад' if reconciled is not None else 'ещё не было'}\n"
+        f"В поиске: {in_search}\n"
+        f"В чате: {in_chat}\n"
+        f"Пар в минуту: {matches_5 / 5:.1f} за 5 мин, {matches_60 / 60:.1f} за час\n"
+        f"Среднее ожидание: {waited_5 / matches_5 if matches_5 else 0:.1f}с за 5 мин, "
+        f"{waited_60 / matches_60 if matches_60 else 0:.1f}с за час\n"
+        f"Переслано сообщений: {relayed_5 / 5:.1f}/мин за 5 мин, {relayed_60} за час\n"
+        f"БД: {pool['in_use']}/{pool['size']} соединений, "
+        f"ожидание {pool['wait_avg'] * 1000:.1f}мс (макс {pool['wait_max'] * 1000:.1f}мс), "
+        f"ошибок {pool['acquire_failures']}\n"
+        f"Кэш пользователей: {len(user_cache)}, попаданий {user_cache.hits}, промахов {user_cache.misses}\n"
+        f"Исходящие: в очереди {len(outbox)}, отправлено {outbox.stats['sent']}, "
+        f"повторов {outbox.stats['retried']}, ошибок {outbox.stats['failed']}, "
+        f"задержка {outbox.latency_avg() * 1000:.0f}мс (макс {outbox.stats['latency_max'] * 1000:.0f}мс)\n"
+        f"Пересылка: в очереди {len(relay)}\n"
+        f"Модерация: в очереди {len(moderation)}, переслано {moderation.stats['forwarded']}, "
+        f"повторов {moderation.stats['duplicates']}, отброшено выборкой {moderation.stats['sampled_out']}"
     )
 
-@dp.message()
-async def handle_chat(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    banned_until = await get_ban_from_db(user_id)
+# === ПЕРЕСЫЛКА СООБЩЕНИЙ ===
+class SenderQueue:
+    __slots__ = ("messages", "wakeup", "task")
+
+    def __init__(self):
+        self.messages = deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+class Relay:
+    """Очередь пересылки на каждого отправителя.
+
+    Сообщения одного пользователя обрабатываются строго по message_id одним воркером,
+    а части альбома (общий media_group_id) собираются в окне album_window и уходят
+    собеседнику одним send_media_group. Воркер завершается, как только очередь пуста.
+
+    Всего в очередях не больше max_pending сообщений: submit ждёт места, и обработчик
+    вместе с ним держит слот вебхука — так переполнение доходит до приёма апдейтов.
+    Отправителю, у которого скопилось sender_limit сообщений, новые отклоняются сразу.
+    """
+
+    def __init__(self, album_window: float, max_pending: int, sender_limit: int):
+        self.album_window = album_window
+        self.sender_limit = sender_limit
+        self.rejected = 0
+        self._slots = asyncio.Semaphore(max_pending)
+        self._senders = {}
+
+    def __len__(self) -> int:
+        return sum(len(sender.messages) for sender in self._senders.values())
+
+    async def submit(self, message: types.Message, timeout: float = None) -> bool:
+        """Ставит сообщение в очередь отправителя; False — очередь переполнена, сообщение не принято."""
+        user_id = message.from_user.id
+        sender = self._senders.get(user_id)
+        if sender is not None and len(sender.messages) >= self.sender_limit:
+            return self._reject()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return self._reject()
+        # Пока ждали места, воркер отправителя мог закончиться и удалить очередь
+        sender = self._senders.get(user_id)
+        if sender is None:
+            sender = self._senders[user_id] = SenderQueue()
+        messages = sender.messages
+        if messages and messages[-1].message_id > message.message_id:
+            # Апдейт обогнал соседний при параллельной обработке — ставим его на своё место
+            index = len(messages)
+            while index and messages[index - 1].message_id > message.message_id:
+                index -= 1
+            messages.insert(index, message)
+        else:
+            messages.append(message)
+        sender.wakeup.set()
+        if sender.task is None:
+            sender.task = asyncio.create_task(self._run(user_id, sender))
+        return True
+
+    def _reject(self) -> bool:
+        self.rejected += 1
+        if METRICS_ENABLED:
+            RELAY_REJECTED.inc()
+        return False
+
+    async def stop(self, timeout: float = 5.0):
+        tasks = [sender.task for sender in self._senders.values() if sender.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def _run(self, user_id: int, sender: SenderQueue):
+        try:
+            while sender.messages:
+                message = sender.messages.popleft()
+                batch = [message]
+                if message.media_group_id:
+                    await self._collect_album(sender, batch)
+                started = time.perf_counter()
+                try:
+                    await relay_messages(user_id, batch)
+                except Exception as e:
+                    logging.error(f"Relay error for {user_id}: {e}")
+                    if METRICS_ENABLED:
+                        RELAY_ERRORS.inc()
+                finally:
+                    for _ in batch:
+                        self._slots.release()
+                    if METRICS_ENABLED:
+                        RELAY_LATENCY.observe(time.perf_counter() - started)
+        finally:
+            sender.task = None
+            if not sender.messages:
+                del self._senders[user_id]
+
+    async def _collect_album(self, sender: SenderQueue, batch: list):
+        group_id = batch[0].media_group_id
+        while len(batch) < MEDIA_GROUP_SIZE:
+            if sender.messages:
+                if sender.messages[0].media_group_id != group_id:
+                    return
+                batch.append(sender.messages.popleft())
+                continue
+            # Окно отсчитывается от последней пришедшей части альбома
+            sender.wakeup.clear()
+            try:
+                await asyncio.wait_for(sender.wakeup.wait(), self.album_window)
+            except asyncio.TimeoutError:
+                return
+
+relay = Relay(RELAY_ALBUM_WINDOW, RELAY_MAX_PENDING, RELAY_SENDER_LIMIT)
+
+def message_media(message: types.Message):
+    """Возвращает (тип, объект файла) для медиа, которое уходит на модерацию, иначе (None, None)."""
+    if message.photo:
+        return "photo", message.photo[-1]
+    if message.video:
+        return "video", message.video
+    if message.voice:
+        return "voice", message.voice
+    if message.animation:
+        return "animation", message.animation
+    return None, None
+
+def relay_call(message: types.Message, partner_id: int):
+    if message.photo:
+        return partial(bot.send_photo, partner_id, photo=message.photo[-1].file_id, caption=message.caption, has_spoiler=True)
+    if message.video:
+        return partial(bot.send_video, partner_id, video=message.video.file_id, caption=message.caption, has_spoiler=True)
+    if message.voice:
+        return partial(bot.send_voice, partner_id, voice=message.voice.file_id, caption=message.caption)
+    if message.animation:
+        return partial(bot.send_animation, partner_id, animation=message.animation.file_id, caption=message.caption, has_spoiler=True)
+    if message.sticker:
+        return partial(bot.send_sticker, partner_id, sticker=message.sticker.file_id)
+    if message.video_note:
+        return partial(bot.send_video_note, partner_id, video_note=message.video_note.file_id)
+    if message.document:
+        return partial(bot.send_document, partner_id, document=message.document.file_id, caption=message.caption)
+    if message.audio:
+        return partial(bot.send_audio, partner_id, audio=message.audio.file_id, caption=message.caption)
+    if message.text:
+        return partial(bot.send_message, partner_id, message.text)
+    # Геопозиция, контакт, опрос и прочее — копией без ссылки на отправителя
+    return partial(bot.copy_message, partner_id, message.chat.id, message.message_id)
+
+def album_item(message: types.Message):
+    if message.photo:
+        return InputMediaPhoto(media=message.photo[-1].file_id, caption=message.caption, has_spoiler=True)
+    if message.video:
+        return InputMediaVideo(media=message.video.file_id, caption=message.caption, has_spoiler=True)
+    if message.document:
+        return InputMediaDocument(media=message.document.file_id, caption=message.caption)
+    return InputMediaAudio(media=message.audio.file_id, caption=message.caption)
+
+async def relay_messages(user_id: int, messages: list):
+    banned_until = bans.get(user_id)
     if is_banned(banned_until):
         return
 
-    if user_id in search_queue:
-        await message.answer("Вы в поиске собеседника. Подождите...", reply_markup=get_search_kb())
+    partner_id = await state_backend.get_partner(user_id)
+    if partner_id is None:
+        first = messages[0]
+        if await state_backend.is_searching(user_id):
+            await first.answer(IN_SEARCH_TEXT, reply_markup=SEARCH_KB)
+        elif not (first.text and first.text.startswith("/")):
+            await first.answer(CHOOSE_ACTION_TEXT, reply_markup=IDLE_KB)
         return
 
-    if user_id not in active_sessions:
-        if not (message.text and message.text.startswith("/")):
-            await message.answer("Выберите действие:", reply_markup=get_idle_kb())
+    if len(messages) == 1:
+        call = relay_call(messages[0], partner_id)
+    else:
+        call = partial(bot.send_media_group, partner_id, [album_item(message) for message in messages])
+    outbox.submit(partner_id, call, PRIORITY_RELAY)
+    bot_stats.relay(len(messages))
+
+    for message in messages:
+        kind, media = message_media(message)
+        if media is None:
+            continue
+        moderation.submit(kind, media.file_id, media.file_unique_id, user_id, message.message_id)
+        # Автоматическая модерация: жалобщика нет, поэтому reporter_id пустой
+        await save_report(None, user_id, message.caption, media.file_id)
+
+@dp.message()
+async def handle_chat(message: types.Message, state: FSMContext):
+    # Проверки и отправка идут в очереди отправителя, чтобы его сообщения не обгоняли друг друга
+    if not await relay.submit(message, RELAY_ADMIT_TIMEOUT):
+        outbox.submit(message.chat.id, partial(bot.send_message, message.chat.id, RELAY_BUSY_TEXT))
+
+# === ВЕБХУК ===
+class OrderedUpdateProcessor:
+    """Параллельная обработка апдейтов с сохранением порядка внутри одного пользователя.
+
+    Порядок держится только в пределах инстанса: балансировщик разносит апдейты одного
+    пользователя по разным инстансам, и там они обрабатываются независимо. Если порядок
+    сообщений важен, вебхук должен обслуживать один инстанс (INSTANCES=1)."""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, concurrency: int, max_pending: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._handlers = asyncio.Semaphore(concurrency)
+        self._admission = asyncio.Semaphore(max_pending)
+        self._queues = {}
+        self._tasks = set()
+        self.pending = 0
+
+    @staticmethod
+    def ordering_key(update: types.Update):
+        context = UserContextMiddleware.resolve_event_context(update)
+        if context.user is not None:
+            return context.user.id
+        if context.chat is not None:
+            return context.chat.id
+        return ("update", update.update_id)
+
+    async def submit(self, update: types.Update, timeout: float = None) -> bool:
+        """Принимает апдейт в обработку; False — очередь переполнена, пусть Telegram повторит позже."""
+        try:
+            await asyncio.wait_for(self._admission.acquire(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.pending += 1
+        key = self.ordering_key(update)
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return True
+        queue = self._queues[key] = deque([update])
+        task = asyncio.create_task(self._drain(key, queue))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _drain(self, key, queue: deque):
+        while queue:
+            try:
+                async with self._handlers:
+                    await self.dispatcher.feed_update(self.bot, queue[0])
+            except Exception as e:
+                logging.error(f"Update error: {e}")
+            finally:
+                queue.popleft()
+                self.pending -= 1
+                self._admission.release()
+        del self._queues[key]
+
+    async def close(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+update_processor = OrderedUpdateProcessor(dp, bot, WEBHOOK_CONCURRENCY, WEBHOOK_MAX_PENDING)
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    if not await update_processor.submit(update, timeout=WEBHOOK_ADMIT_TIMEOUT):
+        return web.Response(status=503)
+    return web.Response()
+
+async def run_webhook():
+    app = web.Application()
+    app.router.add_post(urlparse(WEBHOOK_URL).path or "/", handle_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await dp.emit_startup(bot=bot)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        # Вебхук не удаляем при остановке: за балансировщиком могут работать другие инстансы
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        print(f"✅ Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+        if INSTANCES > 1:
+            logging.warning("Webhook runs with INSTANCES > 1: per-user update order is only kept within an instance")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await update_processor.close()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+# === ВОРКЕРЫ ===
+# События, которые нужно выполнить в воркере шарда пользователя
+SHARD_EVENTS = {
+    "session_started": _session_started,
+    "resume_search": _resume_search,
+    "ban_changed": _ban_changed,
+}
+
+def user_shard(user_id: int) -> int:
+    return user_id % WORKERS
+
+async def on_user_shard(user_id: int, event: str, *args):
+    if WORKERS > 1 and not (IS_WORKER and user_shard(user_id) == WORKER_INDEX):
+        shard = user_shard(user_id)
+        if IS_SUPERVISOR:
+            supervisor.emit(shard, event, list(args))
+        else:
+            await ipc.emit(shard, event, list(args))
         return
+    await SHARD_EVENTS[event](*args)
 
-    partner_id = active_sessions[user_id]
+class WorkerLink:
+    """Канал супервизор → воркер: своя очередь и своя задача-писатель на каждый шард.
 
-    if message.photo:
-        await bot.send_photo(partner_id, photo=message.photo[-1].file_id, caption=message.caption, has_spoiler=True)
-    elif message.video:
-        await bot.send_video(partner_id, video=message.video.file_id, caption=message.caption, has_spoiler=True)
-    elif message.voice:
-        await bot.send_voice(partner_id, voice=message.voice.file_id, caption=message.caption, has_spoiler=True)
-    elif message.animation:
-        await bot.send_animation(partner_id, animation=message.animation.file_id, caption=message.caption, has_spoiler=True)
-    else:
-        await bot.send_message(partner_id, message.text)
+    Пока воркер занят или перезапускается, копится только его очередь, остальные шарды
+    получают апдейты как обычно. Апдейты занимают одно из max_pending мест, события — нет:
+    их шлют другие воркеры, и ожидание места могло бы сцепить двух воркеров намертво.
+    """
+
+    def __init__(self, path: str, max_pending: int):
+        self.path = path
+        self._writer = None
+        self._lines = deque()
+        self._wakeup = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_pending)
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def wait_ready(self):
+        await self._connected.wait()
+
+    async def put(self, line: bytes):
+        await self._slots.acquire()
+        self._lines.append((line, True))
+        self._wakeup.set()
+
+    def put_event(self, line: bytes):
+        self._lines.append((line, False))
+        self._wakeup.set()
+
+    async def _run(self):
+        await self._connect()
+        while True:
+            await self._wakeup.wait()
+            while self._lines:
+                line, is_update = self._lines[0]
+                await self._send(line)
+                self._lines.popleft()
+                if is_update:
+                    self._slots.release()
+            self._wakeup.clear()
+
+    async def _connect(self):
+        while self._writer is None:
+            try:
+                _, self._writer = await asyncio.open_unix_connection(self.path)
+                self._connected.set()
+            except OSError:
+                await asyncio.sleep(0.2)
+
+    async def _send(self, line: bytes):
+        while True:
+            await self._connect()
+            writer = self._writer
+            try:
+                writer.write(line)
+                await writer.drain()
+                return
+            except (ConnectionError, OSError):
+                writer.close()
+                if self._writer is writer:
+                    self._writer = None
+
+    def close(self):
+        self._connected.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.close()
+
+class Supervisor:
+    """Держит общее состояние, запускает воркеры и раздаёт им апдейты по шардам user_id.
 
-    if message.photo or message.video or message.voice or message.animation:
-        await bot.forward_message(CHANNEL_ID, user_id, message.message_id)
+    Упавший воркер перезапускается; апдейты его шарда ждут в очереди WorkerLink, пока он
+    снова подключится. Опрос Telegram встаёт, только когда очередь какого-то шарда заполнена:
+    тогда лишние апдейты ждут на стороне Telegram, а не в памяти супервизора.
+    Таймеры поиска жили в упавшем процессе, поэтому новому воркеру заново отправляется
+    resume_search для каждого пользователя его шарда, который всё ещё в очереди.
+    """
+
+    def __init__(self, count: int, directory: str, backend):
+        self.count = count
+        self.directory = directory
+        self.backend = backend
+        self.links = [WorkerLink(worker_socket_path(directory, i), WORKER_MAX_PENDING) for i in range(count)]
+        self._processes = [None] * count
+        self._monitors = []
+        self._server = None
+        self._stopping = False
+
+    async def start(self):
+        path = control_socket_path(self.directory)
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(self._serve, path=path, limit=IPC_LINE_LIMIT)
+        self._monitors = [asyncio.create_task(self._run_worker(i)) for i in range(self.count)]
+        for link in self.links:
+            link.start()
+        # Опрос Telegram начинаем, только когда все воркеры готовы принимать апдейты
+        await asyncio.gather(*(link.wait_ready() for link in self.links))
+        print(f"✅ Супервизор: {self.count} воркеров, сокеты в {self.directory}")
+
+    async def stop(self, timeout: float = 15.0):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.terminate()
+        _, alive = await asyncio.wait(self._monitors, timeout=timeout) if self._monitors else (None, ())
+        for process in self._processes:
+            if alive and process is not None and process.returncode is None:
+                process.kill()
+        await asyncio.gather(*self._monitors, return_exceptions=True)
+        for link in self.links:
+            await link.stop()
+        if self._server is not None:
+            self._server.close()
+
+    async def _run_worker(self, index: int):
+        env = dict(os.environ, WORKER_INDEX=str(index), IPC_DIR=self.directory)
+        if METRICS_ENABLED:
+            env["METRICS_PORT"] = str(METRICS_PORT + 1 + index)
+        if FSM_SPILL_PATH:
+            env["FSM_SPILL_PATH"] = f"{FSM_SPILL_PATH}.{index}"
+        restarted = False
+        while not self._stopping:
+            process = self._processes[index] = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), env=env,
+            )
+            if restarted:
+                self._resume_shard(index)
+            code = await process.wait()
+            if not self._stopping:
+                logging.error(f"Worker {index} exited with code {code}, restarting")
+                # Старое соединение ведёт в мёртвый процесс: следующая отправка подключится заново
+                self.links[index].close()
+                restarted = True
+                await asyncio.sleep(1)
+
+    def _resume_shard(self, index: int):
+        # Первый запуск покрывает restore_state; здесь — только перезапуск после падения.
+        # Как и restore_state: очередь в Redis здесь не перебираем
+        if not isinstance(self.backend, MemoryStateBackend):
+            return
+        for user_id, _, enqueued_at in list(self.backend.queue.items()):
+            if user_shard(user_id) == index:
+                self.emit(index, "resume_search", [user_id, enqueued_at])
+
+    async def route(self, update: types.Update):
+        key = OrderedUpdateProcessor.ordering_key(update)
+        shard = key % self.count if isinstance(key, int) else update.update_id % self.count
+        line = b'{"update":' + update.model_dump_json(exclude_unset=True, by_alias=True).encode() + b"}\n"
+        await self.links[shard].put(line)
+
+    def emit(self, shard: int, event: str, args: list):
+        # Не ждём доставки: иначе два воркера, ждущие друг друга, могли бы встать намертво
+        self.links[shard].put_event((json.dumps({"event": event, "args": args}) + "\n").encode())
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                request_id, method, args = json.loads(line)
+                try:
+                    if method == "emit":
+                        result = self.emit(*args)
+                    elif method in IPC_METHODS:
+                        result = await getattr(self.backend, method)(*args)
+                    else:
+                        raise ValueError(f"unknown method {method}")
+                    response = [request_id, result, None]
+                except Exception as e:
+                    response = [request_id, None, str(e)]
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+supervisor = None
+
+class ShardRouterMiddleware(BaseMiddleware):
+    """У супервизора обработчики не вызываются: апдейт сразу уходит воркеру своего шарда."""
+
+    async def __call__(self, handler, event, data):
+        await supervisor.route(event)
+
+async def supervisor_startup(bot: Bot):
+    global supervisor
+    supervisor = Supervisor(WORKERS, IPC_DIR or tempfile.mkdtemp(prefix="anonchat-"), state_backend)
+    outbox.start()
+    # Состояние поднимаем до запуска воркеров, чтобы их первые запросы уже видели его
+    await restore_state()
+    state_backend.start()
+    await supervisor.start()
+    start_metrics()
+
+async def supervisor_shutdown(bot: Bot):
+    await supervisor.stop()
+    await outbox.stop()
+    await state_backend.close()
+    print("👋 Воркеры остановлены")
+
+supervisor_links = set()
+
+async def handle_supervisor_link(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    supervisor_links.add(writer)
+    while line := await reader.readline():
+        try:
+            message = json.loads(line)
+            if "update" in message:
+                # Без таймаута: пока очередь полна, копится только очередь этого шарда у супервизора
+                await update_processor.submit(types.Update.model_validate(message["update"], context={"bot": bot}))
+            else:
+                await SHARD_EVENTS[message["event"]](*message["args"])
+        except Exception as e:
+            logging.error(f"Worker link error: {e}")
+    supervisor_links.discard(writer)
+
+async def run_worker():
+    path = worker_socket_path(IPC_DIR, WORKER_INDEX)
+    if os.path.exists(path):
+        os.remove(path)
+    await dp.emit_startup(bot=bot)
+    server = await asyncio.start_unix_server(handle_supervisor_link, path=path, limit=IPC_LINE_LIMIT)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    parent = os.getppid()
+    print(f"✅ Воркер {WORKER_INDEX} готов")
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 2)
+            except asyncio.TimeoutError:
+                # Супервизор умер — воркеру без него делать нечего
+                if os.getppid() != parent:
+                    break
+    finally:
+        server.close()
+        # Закрываем канал от супервизора сами: чтение получит EOF и завершится штатно
+        for writer in list(supervisor_links):
+            writer.close()
+        await update_processor.close()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+async def restore_state():
+    """Поднимает состояние после рестарта: таймеры поиска и уведомления тем, чьё состояние потеряно."""
+    if not isinstance(state_backend, MemoryStateBackend):
+        return
+    lost = state_backend.restore()
+    for user_id, _, enqueued_at in list(state_backend.queue.items()):
+        await on_user_shard(user_id, "resume_search", user_id, enqueued_at)
+    for user_id in lost:
+        outbox.submit(user_id, partial(
+            bot.send_message,
+            user_id,
+            "⚠️ Бот перезапускался, и ваш диалог или поиск не удалось восстановить. Начните заново: /search",
+            reply_markup=IDLE_KB
+        ))
 
 async def on_startup(bot: Bot):
     print("✅ Инициализация PostgreSQL...")
+    await create_db_pool()
     await init_db()
+    if user_cache_sync is not None:
+        user_cache_sync.start()
+    await bot_stats.reconcile()
+    bot_stats.start()
+    timers.start()
+    outbox.start()
+    moderation.start()
+    await restore_state()
+    state_backend.start()
+    if isinstance(fsm_storage, CompactMemoryStorage):
+        fsm_storage.start()
+    rating_writer.start()
+    report_writer.start()
+    start_metrics()
     print("✅ Бот и БД готовы к работе!")
 
+async def on_shutdown(bot: Bot):
+    await timers.stop()
+    await relay.stop()
+    await moderation.stop()
+    await outbox.stop()
+    await rating_writer.stop()
+    await report_writer.stop()
+    await bot_stats.stop()
+    if user_cache_sync is not None:
+        await user_cache_sync.close()
+    await close_db_pool()
+    # aiogram сам хранилище не закрывает: без этого не остановится уборка и не закроется файл выгрузки
+    await fsm_storage.close()
+    await state_backend.close()
+    print("👋 Соединения с БД закрыты")
+
 async def main():
-    dp.startup.register(on_startup)
-    await dp.start_polling(bot)
+    if IS_SUPERVISOR:
+        dp.startup.register(supervisor_startup)
+        dp.shutdown.register(supervisor_shutdown)
+        dp.update.outer_middleware(ShardRouterMiddleware())
+    else:
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
+    if IS_WORKER:
+        await run_worker()
+    elif WEBHOOK_URL:
+        await run_webhook()
+    else:
+        # Супервизору хватает последовательной раздачи — так порядок апдейтов сохраняется сам собой.
+        # Раздача только кладёт апдейт в очередь шарда и ждёт, лишь когда та заполнена
+        await dp.start_polling(bot, handle_as_tasks=not IS_SUPERVISOR)
+
+async def migrate_only():
+    await create_db_pool()
+    try:
+        await init_db()
+    finally:
+        await close_db_pool()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # python main.py migrate — только применить миграции и выйти
+    if MIGRATE_ONLY:
+        asyncio.run(migrate_only())
+    else:
+        asyncio.run(main())
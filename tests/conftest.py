@@ -0,0 +1,8 @@
+import os
+import sys
+
+# main.py читает конфиг при импорте — для тестов хватает заглушек
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("MODERATION_CHANNEL_ID", "-100500")
+os.environ.setdefault("DATABASE_URL", "postgresql://test@127.0.0.1/test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
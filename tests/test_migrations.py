@@ -0,0 +1,152 @@
+"""Миграции против настоящего PostgreSQL.
+
+Сервер берётся из TEST_DATABASE_URL, иначе поднимается временный кластер через initdb,
+как в loadtest.py. Каждый тест работает в своей свежей базе.
+
+    TEST_DATABASE_URL=postgresql://postgres@127.0.0.1:5432/postgres python -m pytest tests
+"""
+import asyncio
+import os
+import uuid
+from urllib.parse import urlparse
+
+import asyncpg
+import pytest
+
+import loadtest
+import main
+
+LEGACY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        own_gender TEXT CHECK (own_gender IN ('male', 'female')),
+        search_preference TEXT CHECK (search_preference IN ('male', 'female', 'any')),
+        banned_until DOUBLE PRECISION DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS ratings (
+        rater_id BIGINT,
+        rated_id BIGINT,
+        rating BOOLEAN,
+        created_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (rater_id, rated_id)
+    );
+    CREATE TABLE IF NOT EXISTS reports (
+        reporter_id BIGINT,
+        reported_id BIGINT,
+        message_text TEXT,
+        media_file_id TEXT,
+        reported_at TIMESTAMP DEFAULT NOW()
+    );
+"""
+
+@pytest.fixture(scope="module")
+def server_url():
+    url = os.getenv("TEST_DATABASE_URL")
+    if url:
+        yield url
+        return
+    try:
+        postgres = loadtest.TempPostgres()
+    except SystemExit:
+        pytest.skip("нет TEST_DATABASE_URL и initdb")
+    yield asyncio.run(postgres.start())
+    asyncio.run(postgres.stop())
+
+@pytest.fixture
+def database_url(server_url):
+    name = f"migrations_{uuid.uuid4().hex[:12]}"
+
+    async def admin(sql: str):
+        conn = await asyncpg.connect(server_url)
+        try:
+            await conn.execute(sql)
+        finally:
+            await conn.close()
+
+    asyncio.run(admin(f"CREATE DATABASE {name}"))
+    yield urlparse(server_url)._replace(path=f"/{name}").geturl()
+    asyncio.run(admin(f"DROP DATABASE {name}"))
+
+async def migrate(url: str):
+    conn = await asyncpg.connect(url)
+    try:
+        await main.migrate(conn)
+    finally:
+        await conn.close()
+
+async def schema(url: str) -> dict:
+    conn = await asyncpg.connect(url)
+    try:
+        return {
+            "version": await conn.fetchval(main.SQL_SCHEMA_VERSION),
+            "version_rows": await conn.fetchval("SELECT COUNT(*) FROM schema_version"),
+            "tables": {row["tablename"] for row in await conn.fetch(
+                "SELECT tablename FROM pg_tables WHERE schemaname = 'public'"
+            )},
+            "indexes": {row["indexname"] for row in await conn.fetch(
+                "SELECT indexname FROM pg_indexes WHERE schemaname = 'public'"
+            )},
+            "reports_columns": {row["column_name"] for row in await conn.fetch(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = 'reports'"
+            )},
+        }
+    finally:
+        await conn.close()
+
+def assert_latest(state: dict):
+    assert state["version"] == len(main.MIGRATIONS)
+    assert state["version_rows"] == 1
+    assert {"users", "ratings", "reports", "user_reputation", "schema_version"} <= state["tables"]
+    assert {"ratings_rated_id_idx", "users_banned_until_idx", "reports_reported_idx"} <= state["indexes"]
+    assert "id" in state["reports_columns"]
+
+def test_empty_database(database_url):
+    asyncio.run(migrate(database_url))
+    assert_latest(asyncio.run(schema(database_url)))
+
+def test_legacy_init_db_database(database_url):
+    async def run():
+        conn = await asyncpg.connect(database_url)
+        try:
+            await conn.execute(LEGACY_SCHEMA)
+            await conn.execute("INSERT INTO users (user_id, own_gender, search_preference) VALUES (1, 'male', 'any')")
+            await conn.executemany(
+                "INSERT INTO ratings (rater_id, rated_id, rating) VALUES ($1, $2, $3)",
+                [(2, 1, True), (3, 1, True), (4, 1, False), (1, 2, False)],
+            )
+            await conn.execute("INSERT INTO reports (reporter_id, reported_id) VALUES (2, 1), (NULL, 1)")
+        finally:
+            await conn.close()
+        await migrate(database_url)
+        conn = await asyncpg.connect(database_url)
+        try:
+            reputation = {row["user_id"]: (row["good"], row["bad"]) for row in await conn.fetch(
+                "SELECT user_id, good, bad FROM user_reputation"
+            )}
+            report_ids = [row["id"] for row in await conn.fetch("SELECT id FROM reports ORDER BY id")]
+            users = await conn.fetchval("SELECT COUNT(*) FROM users")
+        finally:
+            await conn.close()
+        assert reputation == {1: (2, 1), 2: (0, 1)}
+        assert report_ids == [1, 2]
+        assert users == 1
+
+    asyncio.run(run())
+    assert_latest(asyncio.run(schema(database_url)))
+
+def test_rerun_is_noop(database_url, capsys):
+    asyncio.run(migrate(database_url))
+    before = asyncio.run(schema(database_url))
+    capsys.readouterr()
+    asyncio.run(migrate(database_url))
+    assert "Миграция" not in capsys.readouterr().out
+    assert asyncio.run(schema(database_url)) == before
+
+def test_concurrent_runs_apply_each_migration_once(database_url, capsys):
+    async def run():
+        await asyncio.gather(migrate(database_url), migrate(database_url))
+
+    asyncio.run(run())
+    applied = [line for line in capsys.readouterr().out.splitlines() if "Миграция" in line]
+    assert len(applied) == len(main.MIGRATIONS)
+    assert_latest(asyncio.run(schema(database_url)))
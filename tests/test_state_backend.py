@@ -0,0 +1,87 @@
+"""Два воркера над одним Redis (fakeredis с Lua) не должны делить одного пользователя.
+
+    pip install -r requirements-dev.txt
+    python -m pytest tests
+
+Без fakeredis и lupa модуль пропускается целиком.
+"""
+import asyncio
+import random
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+import main
+
+def make_workers(count: int = 2):
+    server = fakeredis.FakeServer()
+    return [
+        main.RedisStateBackend(fakeredis.aioredis.FakeRedis(server=server, decode_responses=True), "test", policy)
+        for policy in ("fifo", "longest_waiting")[:count]
+    ]
+
+async def state(backend) -> tuple:
+    searching = {int(user_id) for user_id in await backend.redis.hkeys(backend.searching_key)}
+    sessions = {int(k): int(v) for k, v in (await backend.redis.hgetall(backend.sessions_key)).items()}
+    return searching, sessions
+
+def test_two_workers_never_double_match():
+    async def run():
+        rng = random.Random(1)
+        workers = make_workers()
+        users = {
+            user_id: (rng.choice(main.GENDERS), rng.choice(main.PREFERENCES), rng.choice(main.TIERS))
+            for user_id in range(1, 2001)
+        }
+
+        async def enqueue(user_id):
+            await asyncio.sleep(rng.random() / 100)
+            return user_id, await rng.choice(workers).enqueue(user_id, *users[user_id])
+
+        results = await asyncio.gather(*(enqueue(user_id) for user_id in users))
+        matched = []
+        for user_id, match in results:
+            if match is not None:
+                matched += [user_id, match[0]]
+                assert main.is_compatible(users[user_id][:2], users[match[0]][:2])
+        assert len(matched) == len(set(matched))
+
+        searching, sessions = await state(workers[0])
+        assert set(sessions) == set(matched)
+        assert all(sessions[sessions[user_id]] == user_id for user_id in sessions)
+        assert not searching & set(sessions)
+        assert searching | set(sessions) == set(users)
+        queued = sum([await workers[0].redis.zcard(workers[0]._bucket_key(bucket)) for bucket in main.BUCKETS])
+        assert queued == len(searching)
+
+    asyncio.run(run())
+
+def test_same_user_on_both_workers_is_queued_once():
+    async def run():
+        workers = make_workers()
+        results = await asyncio.gather(*(
+            worker.enqueue(user_id, "male", "female")
+            for user_id in range(1, 201)
+            for worker in workers
+        ))
+        assert results == [None] * len(results)
+        searching, sessions = await state(workers[0])
+        assert searching == set(range(1, 201)) and not sessions
+        assert await workers[1].redis.zcard(workers[1]._bucket_key(("male", "female", main.TIER_NORMAL))) == 200
+
+    asyncio.run(run())
+
+def test_stale_search_token_does_not_dequeue_new_search():
+    async def run():
+        first, second = make_workers()
+        await first.enqueue(1, "male", "female", main.TIER_NORMAL, 1000.25)
+        assert await second.dequeue(1)
+        await second.enqueue(1, "male", "female", main.TIER_NORMAL, 2000.5)
+        assert not await first.dequeue(1, 1000.25)
+        assert await first.enqueued_at(1) == 2000.5
+        assert await second.dequeue(1, 2000.5)
+        assert not await first.is_searching(1)
+
+    asyncio.run(run())